@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Offline media-processing benchmarks for srp.py (no Telegram connection needed).
+
+    python bench.py [--cases video,gif,image] [--duration 10] [--runs 3]
+                    [--renderers overlay,drawtext] [--profiles fast,balanced,small]
+                    [--json results.json] [--compare previous.json]
+
+Generates synthetic inputs (ffmpeg testsrc videos at 480p/720p/1080p/4K,
+animated GIFs, JPEG/PNG images of several sizes) and runs each through
+srp.process_media with the download stubbed out by a local copy, so the
+convert/watermark/thumbnail path is measured on its own. Every case runs in
+a fresh subprocess and reports median/min wall time, CPU seconds per run
+(including ffmpeg and image workers), peak RSS, output size and, for
+videos, encode fps; video cases run once per renderer and encoding profile.
+--json writes the results; --compare prints the change against an earlier file.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:  # Windows: no CPU/RSS accounting for child processes
+    resource = None
+
+from PIL import Image, ImageDraw
+
+VIDEO_SIZES = {"480p": "854x480", "720p": "1280x720", "1080p": "1920x1080", "4k": "3840x2160"}
+GIF_SIZES = {"small": (320, 240), "large": (800, 600)}
+IMAGE_CASES = {"jpeg-vga": ("JPEG", (640, 480)), "jpeg-1080p": ("JPEG", (1920, 1080)),
+               "jpeg-12mp": ("JPEG", (4000, 3000)), "png-1080p": ("PNG", (1920, 1080))}
+
+
+# ======== Synthetic inputs ========
+def make_test_video(path, size, duration):
+    cmd = [
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc=size={size}:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", path
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True).returncode == 0
+    except FileNotFoundError:
+        return False
+
+
+def make_test_gif(path, size, frames=40):
+    width, height = size
+    images = []
+    for i in range(frames):
+        image = Image.new("RGB", size, (20, 20, 40))
+        draw = ImageDraw.Draw(image)
+        x = (i * width // frames) % width
+        draw.rectangle([x, height // 3, x + width // 6, 2 * height // 3], fill=(220, 120, 40))
+        draw.ellipse([width - x - width // 8, 10, width - x, 10 + width // 8], fill=(60, 180, 220))
+        images.append(image)
+    images[0].save(path, save_all=True, append_images=images[1:], duration=50, loop=0)
+    return True
+
+
+def make_test_image(path, fmt, size):
+    width, height = size
+    # A gradient with some detail, so JPEG/PNG sizes are not trivially small
+    gradient = Image.linear_gradient("L").resize(size)
+    image = Image.merge("RGB", (gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), Image.new("L", size, 90)))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, width, max(1, width // 40)):
+        draw.line([(i, 0), (width - i, height)], fill=(255, 255, 255), width=2)
+    image.save(path, fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return True
+
+
+def build_cases(args, input_dir):
+    """Generate the inputs for the selected case groups; returns [(case, generated_ok)]."""
+    wanted = set(args.cases.split(","))
+    cases = []
+    if "video" in wanted:
+        for label, size in VIDEO_SIZES.items():
+            path = os.path.join(input_dir, f"video_{label}.mp4")
+            ok = make_test_video(path, size, args.duration)
+            for renderer in args.renderers.split(","):
+                for profile in args.profiles.split(","):
+                    cases.append(({"name": f"video-{label}-{renderer}-{profile}", "kind": "video", "input": path,
+                                   "renderer": renderer, "profile": profile}, ok))
+    if "gif" in wanted:
+        for label, size in GIF_SIZES.items():
+            path = os.path.join(input_dir, f"anim_{label}.gif")
+            cases.append(({"name": f"gif-{label}", "kind": "gif", "input": path}, make_test_gif(path, size)))
+    if "image" in wanted:
+        for label, (fmt, size) in IMAGE_CASES.items():
+            path = os.path.join(input_dir, f"image_{label}.{'jpg' if fmt == 'JPEG' else 'png'}")
+            cases.append(({"name": f"image-{label}", "kind": "image", "input": path},
+                          make_test_image(path, fmt, size)))
+    return cases
+
+
+# ======== Case runner (child process) ========
+def usage_snapshot():
+    if resource is None:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        "rss_mb": max(own.ru_maxrss, children.ru_maxrss) / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    }
+
+
+def run_case(case, runs, work_dir):
+    """Run one case runs times in this process and return its measurements."""
+    os.chdir(work_dir)  # srp creates media_temp, its caches and session files in the cwd
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import srp
+
+    if case.get("renderer"):
+        srp.WATERMARK_RENDERER = case["renderer"]
+    if case.get("profile"):
+        srp.CHANNEL_PROFILES = {}
+        srp.ENCODING_PROFILE = case["profile"]
+
+    async def local_download(media_obj, folder=srp.media_folder):
+        dst = os.path.join(folder, os.path.basename(case["input"]))
+        shutil.copyfile(case["input"], dst)
+        return dst
+
+    srp.download_media_file = local_download
+    media_obj = SimpleNamespace(document=None)
+
+    async def run_all():
+        walls, output_bytes, ok = [], 0, True
+        for _ in range(runs):
+            start = time.perf_counter()
+            final, thumb, _ = await srp.process_media(media_obj)
+            walls.append(time.perf_counter() - start)
+            # A failed watermark hands back the (copied) input unchanged
+            if not final or os.path.basename(final) == os.path.basename(case["input"]):
+                ok = False
+            else:
+                output_bytes = os.path.getsize(final)
+            srp.remove_files(final, thumb)
+        return walls, output_bytes, ok
+
+    baseline = usage_snapshot()  # interpreter start-up and imports are not part of the case
+    walls, output_bytes, ok = asyncio.run(run_all())
+    if srp.image_pool:
+        srp.image_pool.shutdown()  # reap the workers so their CPU time is counted
+    usage = usage_snapshot()
+    if usage:
+        usage["cpu"] -= baseline["cpu"]
+    encoded = {name: value for (name, _), value in srp.metrics.counters.items()
+               if name in ("srp_encoded_frames_total", "srp_encode_seconds_total")}
+    return {
+        "name": case["name"],
+        "kind": case["kind"],
+        "ok": ok,
+        "runs": runs,
+        "input_bytes": os.path.getsize(case["input"]),
+        "output_bytes": output_bytes,
+        "wall_median": statistics.median(walls),
+        "wall_min": min(walls),
+        "cpu_per_run": usage["cpu"] / runs if usage else None,
+        "peak_rss_mb": usage["rss_mb"] if usage else None,
+        "encode_fps": (encoded["srp_encoded_frames_total"] / encoded["srp_encode_seconds_total"]
+                       if encoded.get("srp_encode_seconds_total") else None),
+    }
+
+
+def spawn_case(case, runs, work_dir):
+    os.makedirs(work_dir, exist_ok=True)
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case),
+         "--runs", str(runs), "--work-dir", work_dir],
+        capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {"name": case["name"], "kind": case["kind"], "ok": False,
+                "error": (proc.stderr.strip().splitlines() or ["failed"])[-1]}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+# ======== Reporting ========
+def report(result, previous=None):
+    if not result.get("ok") and "wall_median" not in result:
+        print(f"{result['name']:<32} FAILED  {result.get('error', '')}")
+        return
+    cpu = f"{result['cpu_per_run']:7.2f}s" if result.get("cpu_per_run") is not None else "      -"
+    rss = f"{result['peak_rss_mb']:7.1f}MB" if result.get("peak_rss_mb") is not None else "        -"
+    line = (f"{result['name']:<32} wall {result['wall_median']:7.3f}s (min {result['wall_min']:.3f})  "
+            f"cpu {cpu}  rss {rss}  out {result['output_bytes'] / 1024:9.1f}KB")
+    if result.get("encode_fps"):
+        line += f"  {result['encode_fps']:6.1f} fps"
+    if not result["ok"]:
+        line += "  (watermark failed)"
+    if previous and previous.get("wall_median"):
+        line += f"  wall x{result['wall_median'] / previous['wall_median']:.2f} vs previous"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", default="video,gif,image", help="comma-separated case groups")
+    parser.add_argument("--duration", type=int, default=10, help="test video length in seconds")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--renderers", default="overlay", help="video watermark renderers to compare")
+    parser.add_argument("--profiles", default="balanced", help="encoding profiles to compare, e.g. fast,balanced,small")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="earlier --json output to compare against")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case), args.runs, args.work_dir)))
+        return
+
+    previous = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fh:
+            previous = {r["name"]: r for r in json.load(fh)["results"]}
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_dir = os.path.join(tmp_dir, "inputs")
+        os.makedirs(input_dir)
+        for case, generated in build_cases(args, input_dir):
+            if not generated:
+                print(f"{case['name']:<32} skipped (could not generate input; is ffmpeg installed?)")
+                continue
+            result = spawn_case(case, args.runs, os.path.join(tmp_dir, case["name"]))
+            report(result, previous.get(case["name"]))
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"created": time.time(), "args": {"duration": args.duration, "runs": args.runs},
+                       "results": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
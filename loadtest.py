@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end load test for srp.py against a fake Telegram client.
+
+    python loadtest.py [--posts 20] [--bots 4] [--rate 0] [--files 1-5]
+                       [--latency 0.05] [--flood-rate 0.02] [--speed 4] [--workers 0]
+                       [--record trace.jsonl | --replay trace.jsonl] [--json out.json]
+
+FakeClient stands in for the TelegramClient surface srp uses (event
+dispatch, get_entity, get_messages, send_file, send_message,
+forward_messages, edit_message, download_media, iter_download, upload_file)
+with configurable latency and randomly injected FloodWait errors. Fake
+source bots answer /start with scripted media, and a fake batch bot runs
+the /batch and /genlink dialogues. Each channel post is timed from the
+moment it appears until its caption is edited with the generated link;
+the run reports latency percentiles, throughput and scheduler counters.
+Each fake account moves bytes over its own link of --bandwidth-mb, and
+--workers adds worker accounts (sharing the same fake chats) to srp's
+account pool, with a staging chat so downloads can be sharded too.
+
+Media processing is replaced by a copy with configurable latency unless
+--real-media is given (which needs ffmpeg for videos). --record writes
+every event the bot received to a JSON-lines trace; --replay rebuilds the
+same posts and source-bot timings from such a trace.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+from types import SimpleNamespace
+
+from telethon import errors
+from telethon.tl import types
+
+BATCH_BOT_ID = 900000
+SOURCE_BOT_BASE_ID = 910000
+STAGING_CHAT_ID = -100900000
+
+
+# ======== Scenarios ========
+def parse_range(text):
+    low, _, high = text.partition("-")
+    return int(low), int(high or low)
+
+
+def generate_scenario(args):
+    """
+    Random posts for --posts/--bots. A scenario holds the channel posts
+    ({"t", "parts": [{"caption", "media"}]}) and, per /start id, the source
+    bot's script ([{"after", "media"} or {"after", "text"}]).
+    """
+    rng = random.Random(args.seed)
+    doc_ids = itertools.count(1_000_000)
+    low, high = parse_range(args.files)
+    size_low, size_high = (int(float(v) * 1024 * 1024) for v in args.size_mb.split("-"))
+    posts, scripts, t = [], {}, 0.0
+
+    def media_spec():
+        kind = "video" if rng.random() < args.video_fraction else "photo"
+        size = rng.randint(size_low, size_high) if kind == "video" else rng.randint(50_000, 400_000)
+        return {"kind": kind, "id": next(doc_ids), "size": size}
+
+    for i in range(args.posts):
+        bot = f"@fake_source_{i % args.bots}_bot"
+        start_id = f"post{i}"
+        caption = f"New drop https://t.me/{bot[1:]}?start={start_id}"
+        parts = [{"caption": caption, "media": media_spec()}]
+        if rng.random() < args.album_fraction:
+            parts += [{"caption": None, "media": media_spec()} for _ in range(rng.randint(1, 3))]
+        posts.append({"t": round(t, 3), "parts": parts})
+
+        script, after = [], rng.uniform(0.2, 1.0)
+        for _ in range(rng.randint(low, high)):
+            script.append({"after": round(after, 3), "media": media_spec()})
+            after += rng.expovariate(1 / args.media_gap)
+        if rng.random() < args.done_fraction:
+            script.append({"after": round(after, 3), "text": "All files sent ✅"})
+        scripts[start_id] = script
+        if args.rate:
+            t += rng.expovariate(args.rate)
+    return {"posts": posts, "scripts": scripts}
+
+
+def scenario_from_trace(path):
+    """Rebuild posts and source-bot scripts from a --record trace."""
+    posts, groups, scripts = [], {}, {}
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            record = json.loads(line)
+            if record["type"] == "post":
+                part = {"caption": record.get("caption"), "media": record["media"]}
+                if record.get("grouped_id") in groups:
+                    groups[record["grouped_id"]]["parts"].append(part)
+                    continue
+                post = {"t": record["t"], "parts": [part]}
+                posts.append(post)
+                if record.get("grouped_id"):
+                    groups[record["grouped_id"]] = post
+            elif record["type"] == "bot":
+                step = {"after": record["after"]}
+                step.update({"media": record["media"]} if record.get("media") else {"text": record["text"]})
+                scripts.setdefault(record["start_id"], []).append(step)
+    return {"posts": posts, "scripts": scripts}
+
+
+class TraceRecorder:
+    """Writes every post and source-bot message delivered to the bot as one JSON line."""
+
+    def __init__(self, path):
+        self.fh = open(path, "w", encoding="utf-8") if path else None
+
+    def write(self, record):
+        if self.fh:
+            self.fh.write(json.dumps(record) + "\n")
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+
+
+# ======== Fake Telegram ========
+def make_media(spec):
+    if spec["kind"] == "photo":
+        photo = types.Photo(id=spec["id"], access_hash=1, file_reference=b"", date=None, dc_id=2,
+                            sizes=[types.PhotoSize("y", 1280, 720, spec["size"])])
+        return types.MessageMediaPhoto(photo=photo)
+    document = types.Document(
+        id=spec["id"], access_hash=1, file_reference=b"", date=None, mime_type="video/mp4",
+        size=spec["size"], dc_id=2,
+        attributes=[types.DocumentAttributeVideo(duration=30, w=1280, h=720, supports_streaming=True),
+                    types.DocumentAttributeFilename(f"{spec['id']}.mp4")])
+    return types.MessageMediaDocument(document=document)
+
+
+class FakeMessage:
+    def __init__(self, msg_id, chat_id, sender_id, text="", media=None, grouped_id=None, out=False):
+        self.id = msg_id
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.message = text
+        self.media = media
+        self.grouped_id = grouped_id
+        self.out = out
+
+    @property
+    def text(self):
+        return self.message
+
+    raw_text = text
+
+    @property
+    def photo(self):
+        return getattr(self.media, "photo", None)
+
+    @property
+    def document(self):
+        return getattr(self.media, "document", None)
+
+    @property
+    def video(self):
+        document = self.document
+        return document if document and document.mime_type.startswith("video/") else None
+
+
+class FakeEvent:
+    def __init__(self, message):
+        self.message = message
+        self.chat_id = message.chat_id
+        self.sender_id = message.sender_id
+        self.out = message.out
+        self.media = message.media
+        self.raw_text = message.message
+
+
+class FakeClient:
+    """
+    The subset of TelegramClient that srp calls. Every API method sleeps for
+    the configured latency and may raise FloodWaitError; replies from the
+    fake bots are delivered through the handlers srp registered. A worker
+    (main given) is another account on the same fake server: it shares the
+    chats and timings of main but has its own link and FloodWaits.
+    """
+
+    def __init__(self, srp, scenario, args, recorder, main=None):
+        self.srp = srp
+        self.scenario = scenario
+        self.args = args
+        self.recorder = recorder
+        self.rng = random.Random(args.seed + (len(main.workers) + 1 if main else 0))
+        self.workers = []
+        self.link_free_at = 0.0       # when this account's link finishes its queued bytes
+        self.flood_waits = 0
+        self.calls = 0
+        self.bytes = 0
+        if main:
+            main.workers.append(self)
+            for shared in ("handlers", "msg_ids", "chats", "entities", "posted_at", "done_at", "started", "tasks"):
+                setattr(self, shared, getattr(main, shared))
+            return
+        self.handlers = srp.client.list_event_handlers()
+        self.msg_ids = itertools.count(1)
+        self.chats = {}               # chat id -> {msg id: FakeMessage}
+        self.entities = {"@" + srp.batch_bot_username.lstrip("@"): BATCH_BOT_ID}
+        self.batch_state = None
+        self.posted_at = {}           # channel post id -> time posted
+        self.done_at = {}             # channel post id -> time its caption was edited
+        self.started = time.perf_counter()
+        self.tasks = set()
+
+    # --- plumbing ---
+    def now(self):
+        return time.perf_counter() - self.started
+
+    async def api(self, method, size=0):
+        self.calls += 1
+        self.bytes += size
+        latency = self.args.latency * self.rng.uniform(0.5, 1.5)
+        if size:
+            # Transfers on one account share its link and finish in turn
+            self.link_free_at = max(self.now(), self.link_free_at) + size / (self.args.bandwidth_mb * 1024 * 1024)
+            latency = max(latency, self.link_free_at - self.now())
+        await asyncio.sleep(latency)
+        if self.rng.random() < self.args.flood_rate:
+            self.flood_waits += 1
+            raise errors.FloodWaitError(request=None, capture=self.rng.randint(1, self.args.flood_seconds))
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def store(self, message):
+        self.chats.setdefault(message.chat_id, {})[message.id] = message
+        return message
+
+    def deliver(self, message):
+        """Run srp's handlers for a new message, like Telethon does for each update."""
+        async def dispatch():
+            event = FakeEvent(message)
+            for callback, builder in self.handlers:
+                if builder.incoming and message.out or builder.outgoing and not message.out:
+                    continue
+                if builder.chats is not None and message.chat_id not in (
+                        builder.chats if isinstance(builder.chats, (list, tuple, set)) else [builder.chats]):
+                    continue
+                try:
+                    await callback(event)
+                except Exception as e:
+                    logging.getLogger("loadtest").error(f"handler {callback.__name__} failed: {e}")
+        self.spawn(dispatch())
+
+    # --- scenario driving ---
+    async def run_posts(self):
+        grouped_ids = itertools.count(1)
+        for post in self.scenario["posts"]:
+            await asyncio.sleep(max(0.0, post["t"] / self.args.speed - self.now()))
+            grouped_id = next(grouped_ids) if len(post["parts"]) > 1 else None
+            for part in post["parts"]:
+                message = self.store(FakeMessage(next(self.msg_ids), self.srp.target_channel_id, None,
+                                                 part["caption"] or "", make_media(part["media"]), grouped_id))
+                if part["caption"]:
+                    self.posted_at[message.id] = self.now()
+                self.recorder.write({"type": "post", "t": round(self.now() * self.args.speed, 3),
+                                     "caption": part["caption"], "media": part["media"], "grouped_id": grouped_id})
+                self.deliver(message)
+
+    async def run_source_bot(self, bot_id, start_id):
+        started = self.now()
+        for step in self.scenario["scripts"].get(start_id, []):
+            await asyncio.sleep(max(0.0, started + step["after"] / self.args.speed - self.now()))
+            media = make_media(step["media"]) if step.get("media") else None
+            message = self.store(FakeMessage(next(self.msg_ids), bot_id, bot_id, step.get("text", ""), media))
+            self.recorder.write({"type": "bot", "start_id": start_id, "t": round(self.now() * self.args.speed, 3),
+                                 "after": round((self.now() - started) * self.args.speed, 3),
+                                 "media": step.get("media"), "text": step.get("text")})
+            self.deliver(message)
+
+    def batch_bot_reply(self, text):
+        async def reply():
+            await asyncio.sleep(self.args.latency)
+            self.deliver(self.store(FakeMessage(next(self.msg_ids), BATCH_BOT_ID, BATCH_BOT_ID, text)))
+        self.spawn(reply())
+
+    def new_link(self):
+        return f"https://t.me/fake_batch_bot?start=link{next(self.msg_ids)}"
+
+    # --- TelegramClient surface ---
+    async def get_entity(self, username):
+        await self.api("get_entity")
+        if username not in self.entities:
+            self.entities[username] = SOURCE_BOT_BASE_ID + len(self.entities)
+        return SimpleNamespace(id=self.entities[username], username=username.lstrip("@"))
+
+    async def send_message(self, entity, text, **kwargs):
+        await self.api("send_message")
+        message = self.store(FakeMessage(next(self.msg_ids), entity.id, None, text, out=True))
+        if entity.id == BATCH_BOT_ID:
+            if text == "/batch":
+                self.batch_state = "first"
+                self.batch_bot_reply("Send the first message link of the batch.")
+            elif text == "/genlink":
+                self.batch_state = "genlink"
+                self.batch_bot_reply("Send me the message you want a link for.")
+            elif self.batch_state == "first":
+                self.batch_state = "last"
+                self.batch_bot_reply("Now send the last message link.")
+            elif self.batch_state == "last":
+                self.batch_state = None
+                self.batch_bot_reply(f"Here is your batch link: {self.new_link()}")
+        elif text.startswith("/start "):
+            self.spawn(self.run_source_bot(entity.id, text.split(" ", 1)[1]))
+        return message
+
+    async def forward_messages(self, entity, messages, from_peer=None, **kwargs):
+        # Like Telethon: a message, or a message id with from_peer; anything else is a TypeError
+        if isinstance(messages, int):
+            message = self.chats.get(getattr(from_peer, "id", from_peer), {}).get(messages)
+        elif isinstance(messages, FakeMessage):
+            message = messages
+        else:
+            raise TypeError(f"Cannot forward {type(messages).__name__}")
+        await self.api("forward_messages")
+        if message is None:
+            raise errors.MessageIdInvalidError(request=None)
+        if entity == STAGING_CHAT_ID:
+            return self.store(FakeMessage(next(self.msg_ids), STAGING_CHAT_ID, None, "", message.media, out=True))
+        forwarded = self.store(FakeMessage(next(self.msg_ids), entity.id, None, "", out=True))
+        if entity.id == BATCH_BOT_ID and self.batch_state == "genlink":
+            self.batch_state = None
+            self.batch_bot_reply(f"Here is your link: {self.new_link()}")
+        return forwarded
+
+    async def edit_message(self, chat, msg_id, text, **kwargs):
+        await self.api("edit_message")
+        message = self.chats.get(chat, {}).get(msg_id)
+        if message:
+            message.message = text
+        if msg_id in self.posted_at and msg_id not in self.done_at:
+            self.done_at[msg_id] = self.now()
+        return message
+
+    async def get_messages(self, chat, ids=None, **kwargs):
+        await self.api("get_messages")
+        chat_id = getattr(chat, "id", chat)
+        messages = self.chats.get(chat_id, {})
+        if isinstance(ids, list):
+            return [messages.get(i) for i in ids]
+        return messages.get(ids)
+
+    async def delete_messages(self, chat, ids, **kwargs):
+        await self.api("delete_messages")
+        for msg_id in ids:
+            self.chats.get(chat, {}).pop(msg_id, None)
+
+    async def get_me(self):
+        await self.api("get_me")
+        return SimpleNamespace(id=1)
+
+    async def send_file(self, entity, file, **kwargs):
+        files = file if isinstance(file, list) else [file]
+        await self.api("send_file", size=0)
+        grouped_id = next(self.msg_ids) if len(files) > 1 else None
+        sent = []
+        for input_media in files:
+            if isinstance(input_media, (types.InputMediaUploadedPhoto, types.InputPhoto)):
+                spec = {"kind": "photo", "id": next(self.msg_ids), "size": 1}
+            else:
+                spec = {"kind": "video", "id": next(self.msg_ids), "size": 1}
+            message = self.store(FakeMessage(next(self.msg_ids), entity, None, "", make_media(spec), grouped_id, out=True))
+            self.deliver(message)
+            sent.append(message)
+        return sent if isinstance(file, list) else sent[0]
+
+    async def upload_file(self, file_path, **kwargs):
+        await self.api("upload_file", size=os.path.getsize(file_path))
+        return types.InputFile(id=next(self.msg_ids), parts=1, name=os.path.basename(file_path), md5_checksum="")
+
+    async def __call__(self, request):
+        await self.api(type(request).__name__, size=len(getattr(request, "bytes", b"")))
+        return True
+
+    async def download_media(self, media, file=None, **kwargs):
+        document = getattr(media, "document", None)
+        size = document.size if document else media.photo.sizes[-1].size
+        await self.api("download_media", size=size)
+        path = os.path.join(file, f"{(document or media.photo).id}{'.mp4' if document else '.jpg'}")
+        with open(path, "wb") as fh:
+            fh.truncate(size)
+        return path
+
+    async def iter_download(self, document, offset=0, limit=None, request_size=512 * 1024, file_size=None, **kwargs):
+        size = file_size or document.size
+        for index in range(limit or -(-size // request_size)):
+            start = offset + index * request_size
+            if start >= size:
+                return
+            await self.api("GetFileRequest", size=min(request_size, size - start))
+            yield bytes(min(request_size, size - start))
+
+
+# ======== Run ========
+def fake_prepare(args):
+    async def prepare_media_file(media_obj, file_path):
+        await asyncio.sleep(args.process_latency * random.uniform(0.5, 1.5))
+        output = os.path.join(os.path.dirname(file_path), "wm_" + os.path.basename(file_path))
+        shutil.copyfile(file_path, output)
+        info = {"width": 1280, "height": 720, "duration": 30} if output.endswith(".mp4") else {}
+        return output, None, info
+    return prepare_media_file
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+async def run(args, scenario, srp, recorder):
+    fake = FakeClient(srp, scenario, args, recorder)
+    srp.client = fake
+    for index in range(args.workers):
+        srp.accounts.accounts.append(srp.Account(f"worker{index + 1}", FakeClient(srp, scenario, args, recorder, fake)))
+    if args.workers:
+        srp.WORKER_STAGING_CHAT = STAGING_CHAT_ID
+        srp.api_scheduler.on_flood_wait = srp.accounts.throttle
+    await fake.run_posts()
+
+    deadline = time.perf_counter() + args.timeout
+    while len(fake.done_at) < len(fake.posted_at) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+    elapsed = fake.now()
+
+    latencies = [fake.done_at[i] - fake.posted_at[i] for i in fake.done_at]
+    for task in list(fake.tasks):
+        task.cancel()
+    return {
+        "posts": len(fake.posted_at),
+        "completed": len(latencies),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_posts_per_min": round(len(latencies) / elapsed * 60, 2) if elapsed else None,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p90": percentile(latencies, 0.90),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": max(latencies, default=None),
+        "api_calls": fake.calls + sum(worker.calls for worker in fake.workers),
+        "flood_waits_injected": fake.flood_waits + sum(worker.flood_waits for worker in fake.workers),
+        "transfer_mb_per_account": " / ".join(f"{account.bytes / 1024 ** 2:.1f}"
+                                              for account in (fake, *fake.workers)),
+        "scheduler": srp.api_scheduler.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--posts", type=int, default=20, help="channel posts to simulate")
+    parser.add_argument("--bots", type=int, default=4, help="distinct source bots")
+    parser.add_argument("--rate", type=float, default=0, help="posts per second (0: all at once)")
+    parser.add_argument("--files", default="1-5", help="media per /start, e.g. 1-5")
+    parser.add_argument("--album-fraction", type=float, default=0.2, help="share of posts made as albums")
+    parser.add_argument("--video-fraction", type=float, default=0.5)
+    parser.add_argument("--size-mb", default="0.5-4", help="video size range in MB")
+    parser.add_argument("--media-gap", type=float, default=1.0, help="mean seconds between a bot's media")
+    parser.add_argument("--done-fraction", type=float, default=0.5, help="share of bots that say when they are done")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean API call latency in seconds")
+    parser.add_argument("--bandwidth-mb", type=float, default=50, help="simulated transfer speed, MB/s")
+    parser.add_argument("--process-latency", type=float, default=0.3, help="mean fake watermark time per file")
+    parser.add_argument("--flood-rate", type=float, default=0.02, help="probability of a FloodWait per call")
+    parser.add_argument("--flood-seconds", type=int, default=2, help="longest injected FloodWait")
+    parser.add_argument("--workers", type=int, default=0, help="extra accounts in srp's account pool")
+    parser.add_argument("--speed", type=float, default=4, help="divide srp's session timers and scenario delays by this")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for the last post")
+    parser.add_argument("--real-media", action="store_true", help="run the real watermark path instead of a copy")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="write the delivered events to this JSON-lines trace")
+    parser.add_argument("--replay", help="rebuild the scenario from a recorded trace")
+    parser.add_argument("--json", help="write the summary to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show srp's log")
+    args = parser.parse_args()
+
+    scenario = scenario_from_trace(args.replay) if args.replay else generate_scenario(args)
+    for option in ("record", "replay", "json"):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)  # srp keeps media_temp, its cache and journal in the cwd
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import srp
+
+        logging.getLogger("srp").setLevel(logging.INFO if args.verbose else logging.WARNING)
+        for name in ("SESSION_FIRST_MEDIA_TIMEOUT", "SESSION_IDLE_GAP", "SESSION_IDLE_GAP_MIN",
+                     "SESSION_IDLE_GAP_MAX", "SESSION_MAX_DURATION", "ALBUM_DEBOUNCE", "REPLY_TIMEOUT"):
+            setattr(srp, name, getattr(srp, name) / args.speed)
+        if not args.real_media:
+            srp.STREAM_DOWNLOADS = False
+            srp.prepare_media_file = fake_prepare(args)
+
+        recorder = TraceRecorder(args.record)
+        try:
+            summary = asyncio.run(run(args, scenario, srp, recorder))
+        finally:
+            recorder.close()
+            if srp.image_pool:
+                srp.image_pool.shutdown()
+
+    for key, value in summary.items():
+        print(f"{key:<26} {round(value, 3) if isinstance(value, float) else value}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(summary, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,29 @@
 #!/usr/bin/env python3
 import os
 import json
-import subprocess
+import math
+import contextlib
 import asyncio
 import logging
 import re
 import random
-from telethon import TelegramClient, events
-from telethon.tl.types import DocumentAttributeVideo
-from PIL import Image, ImageDraw, ImageFont
+import mimetypes
+import hashlib
+import shutil
+import itertools
+import heapq
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from telethon import TelegramClient, events, utils, helpers, errors
+from telethon.tl.functions.upload import SaveBigFilePartRequest
+from telethon.tl.types import (
+    DocumentAttributeVideo, DocumentAttributeFilename,
+    InputMediaUploadedDocument, InputMediaUploadedPhoto,
+    InputDocument, InputPhoto, InputFileBig,
+)
+from PIL import Image, ImageDraw, ImageFont, JpegImagePlugin
 
 # === Setup logger ===
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -24,26 +39,200 @@ target_channel_id = -1003282977217
 media_folder = "media_temp"
 os.makedirs(media_folder, exist_ok=True)
 
-client = TelegramClient('corning_session', api_id, api_hash)
+# FloodWaits are surfaced to api_scheduler instead of being slept inside Telethon
+client = TelegramClient('corning_session', api_id, api_hash, flood_sleep_threshold=0)
 
 # === Regex patterns ===
 link_regex = re.compile(r'https://t\.me/([^?]+)\?start=([\w-]+)', re.IGNORECASE)
 batch_link_regex = re.compile(r'https://t\.me/[^?]+\?start=[\w-]+', re.IGNORECASE)
 
 # === Session state ===
-active_session = False
-media_from_bot = []
-original_batch_msg = None
-original_caption = None
-first_msg_link = None
-last_msg_link = None
-bot_sender_id = None
+# A session closes once its source bot goes quiet for the idle gap, says it
+# is done, sends nothing within the first-media timeout, or hits the hard cap.
+SESSION_FIRST_MEDIA_TIMEOUT = 30
+SESSION_IDLE_GAP = 6                  # seconds; starting value before enough gaps are seen
+SESSION_IDLE_GAP_MIN = 3
+SESSION_IDLE_GAP_MAX = 20
+SESSION_ADAPTIVE_IDLE_GAP = True      # tune the idle gap from observed inter-arrival gaps
+SESSION_MAX_DURATION = 180
+source_done_regex = re.compile(r'all (?:the )?(?:files|videos|media)\b.*\b(?:sent|delivered)', re.IGNORECASE)
+arrival_gaps = deque(maxlen=500)      # seconds between consecutive media from a source bot
+REPLY_TIMEOUT = 60      # seconds to wait for a bot's reply during a dialogue
+
+# === Album settings ===
+# Album parts arrive as separate events; they are buffered per grouped_id
+# and handled once, ALBUM_DEBOUNCE seconds after the last part.
+ALBUM_DEBOUNCE = 1.0
+album_parts = {}                 # grouped_id -> [Message]
+album_timers = {}                # grouped_id -> asyncio.TimerHandle
+flushed_albums = OrderedDict()   # recently handled grouped_ids, oldest first
+FLUSHED_ALBUMS_KEPT = 1000
+sessions = {}           # (bot sender id, request id) -> FetchSession
+active_by_bot = {}      # bot sender id -> FetchSession currently collecting from that bot
+bot_locks = {}          # bot sender id -> asyncio.Lock; same-bot requests queue on it
+request_ids = itertools.count(1)
+channel_post_lock = asyncio.Lock()  # a batch posts contiguously so its first..last range is its own
+
+# === Pipeline settings ===
+# handle_batch runs download -> watermark -> upload as concurrent stages.
+DOWNLOAD_WORKERS = 2
+PROCESS_WORKERS = 2
+UPLOAD_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 2  # finished items buffered between two stages
+
+# === Upload settings ===
+UPLOAD_GROUP_SIZE = 10       # files posted together as one album (Telegram's maximum)
+UPLOAD_PARALLEL_PARTS = 4    # file parts in flight at once for big (>10 MB) uploads
+# Telegram's limits for a photo; larger images are posted as documents
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+PHOTO_MAX_SIDES_SUM = 10000  # width + height
+PHOTO_MAX_RATIO = 20
+
+# === Request scheduler settings ===
+# Every client call goes through api_scheduler. Calls are paced by a token
+# bucket per (method, peer) plus one per peer shared by all methods; waiting
+# calls are served in priority order, so caption edits and link generation
+# get ahead of bulk uploads to the same chat. Methods missing here (file
+# parts, downloads) are not paced, only retried on FloodWait.
+API_RATE_LIMITS = {              # method -> (requests per second, burst)
+    "send_message": (1.0, 3),
+    "send_file": (0.5, 3),
+    "forward_messages": (1.0, 3),
+    "edit_message": (1.0, 3),
+    "get_messages": (2.0, 5),
+    "get_entity": (1.0, 3),
+}
+API_PEER_RATE_LIMIT = (1.0, 5)   # all paced methods to one chat together
+FLOOD_WAIT_RETRIES = 3
+FLOOD_WAIT_MAX = 900             # seconds; longer waits fail the call instead of stalling it
+PRIORITY_HIGH = 0                # caption edits, link generation
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2                # channel posts, uploads, downloads
+
+# === Link service settings ===
+# All link generation goes through one ordered conversation with the batch
+# bot (link_service). LINK_PIPELINE_DEPTH requests may be waiting for their
+# link at once: the next /batch or /genlink goes out as soon as the previous
+# request's last message is sent. 1 waits for each link before the next request.
+# Raise it only for a batch bot that answers in order and sets reply_to.
+LINK_PIPELINE_DEPTH = 1
+ENTITY_CACHE_TTL = 6 * 3600         # seconds a resolved username is reused
+CAPTION_EDIT_BATCH_WINDOW = 0.5     # seconds caption edits are gathered before they are sent
+
+# === Worker account settings ===
+# Extra Telegram accounts that share download and upload work with the main
+# account (`client`), which keeps the event handlers, link generation and
+# caption edits. WORKER_ACCOUNTS_FILE is a JSON list of {"name", "session",
+# "api_id", "api_hash"} (api_id/api_hash default to ours) for sessions that are
+# already logged in. Workers post the files they upload, so they must be admins
+# of target_channel_id; the main account needs the right to edit their posts.
+# A worker can't open the main account's messages, so large downloads reach it
+# through WORKER_STAGING_CHAT, a chat every account is in; without one,
+# downloads stay on the main account.
+WORKER_ACCOUNTS_FILE = "accounts.json"
+WORKER_STAGING_CHAT = None
+WORKER_HEALTH_INTERVAL = 60      # seconds between get_me checks of each worker
+WORKER_HEALTH_FAILURES = 3       # failed checks in a row before a worker leaves rotation
+
+# === Metrics settings ===
+# Stage timings, counters and queue depths are served as Prometheus text on
+# http://METRICS_HOST:METRICS_PORT/metrics; every span can also be appended
+# to TRACE_FILE as one JSON line tagged with its job id.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464              # None disables the endpoint
+TRACE_FILE = None                # e.g. "traces.jsonl"
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# === Scratch space settings ===
+# Every pipeline run works in its own directory under media_folder, removed
+# when the run ends. Downloads wait while the files in flight would exceed
+# the quota; small files are staged in RAM (tmpfs) when SCRATCH_SHM_DIR exists.
+SCRATCH_QUOTA_BYTES = 4 * 1024 ** 3
+SCRATCH_SIZE_FACTOR = 3            # bytes reserved per source byte: download, watermarked copy, segments
+SCRATCH_SHM_DIR = "/dev/shm"       # None disables RAM staging
+SCRATCH_SHM_MAX_BYTES = 8 * 1024 * 1024
+
+# === Job journal settings ===
+# Sessions and per-item progress are journaled so a restart resumes
+# unfinished jobs from their last completed stage.
+JOURNAL_FILE = "jobs.db"
+
+# === Dedup cache settings ===
+# Remembers what was already watermarked and uploaded so repeats are re-sent by reference.
+MEDIA_CACHE_FILE = "media_cache.json"
+MEDIA_CACHE_MAX_ENTRIES = 5000
+MEDIA_CACHE_MAX_BYTES = 50 * 1024 ** 3  # total source size the cache may stand in for
+
+# === Media tool settings ===
+FFMPEG_TIMEOUT = 1800  # seconds before a stuck ffmpeg encode is killed
+FFPROBE_TIMEOUT = 60
+MAX_CONCURRENT_ENCODES = max(1, (os.cpu_count() or 2) // 2)
+IMAGE_WORKERS = os.cpu_count() or 1  # Pillow process pool size
+
+# === Download settings ===
+# Big documents are split into byte ranges fetched concurrently; set
+# DOWNLOAD_CONNECTIONS = 1 to always use the single-stream download_media path.
+DOWNLOAD_CONNECTIONS = 4
+PARALLEL_DOWNLOAD_MIN_BYTES = 10 * 1024 * 1024
+DOWNLOAD_REQUEST_SIZE = 512 * 1024  # bytes per GetFile request (multiple of 4 KB, at most 512 KB)
+
+# === Streaming settings ===
+# Large videos are fed from iter_download straight into ffmpeg's stdin so
+# encoding overlaps the download; anything that needs seeking goes to disk.
+STREAM_DOWNLOADS = True
+STREAM_MIN_BYTES = 20 * 1024 * 1024
+STREAM_CHUNK_SIZE = 512 * 1024
+STREAMABLE_MIME_TYPES = ("video/mp4", "video/quicktime", "video/webm", "video/x-matroska")
+
+# === Parallel encode settings ===
+# Long, large videos are cut at keyframes and the segments watermarked concurrently.
+PARALLEL_ENCODE = True
+PARALLEL_MIN_DURATION = 120          # seconds
+PARALLEL_MIN_PIXELS = 1280 * 720     # width * height
+PARALLEL_MAX_SEGMENTS = os.cpu_count() or 1
+PARALLEL_MIN_SEGMENT_SECONDS = 20
+
+# === Encoding profiles ===
+# libx264 preset/CRF per profile; max_height caps the short side (downscaling
+# larger videos) and maxrate_kbps caps the bitrate. Profiles are picked per
+# target channel. ENCODE_TARGET_MB lowers the bitrate cap so a video fits that
+# upload size; ENCODE_TIME_BUDGET (seconds per video) switches to faster
+# presets, then smaller sizes, when the expected encode time is over it.
+ENCODING_PROFILES = {
+    "fast": {"preset": "veryfast", "crf": 26, "max_height": 720, "maxrate_kbps": None},
+    "balanced": {"preset": "medium", "crf": 23, "max_height": 1080, "maxrate_kbps": None},
+    "small": {"preset": "slow", "crf": 28, "max_height": 720, "maxrate_kbps": 1500},
+}
+ENCODING_PROFILE = "balanced"
+CHANNEL_PROFILES = {target_channel_id: "balanced"}
+ENCODE_TARGET_MB = None
+ENCODE_TIME_BUDGET = None
+ENCODE_AUDIO_KBPS = 128
+# Fastest last; speeds relative to "medium", used to estimate encode time
+PRESET_SPEEDS = {"slow": 0.6, "medium": 1.0, "fast": 1.3, "faster": 1.7,
+                 "veryfast": 2.6, "superfast": 3.5, "ultrafast": 5.0}
+
+# === Fast path settings ===
+# classify_media routes each downloaded file to the cheapest path that still
+# watermarks it. Files that can't be probed or decoded are posted unchanged.
+SHORT_CLIP_SECONDS = 15              # clips this short, at most SHORT_CLIP_MAX_PIXELS, use SHORT_CLIP_PROFILE
+SHORT_CLIP_MAX_PIXELS = 1280 * 720
+SHORT_CLIP_PROFILE = "fast"
+SMALL_IMAGE_BYTES = 256 * 1024       # smaller JPEGs keep their own quality tables instead of quality 95
+IMAGE_MAX_SIDE = 2560                # Telegram's largest photo side; bigger JPEGs decode at a reduced scale
+STILL_IMAGE_CODECS = ("mjpeg", "png", "bmp", "webp")  # a lone cover picture, not a real video stream
 
 # === Watermark settings ===
 WATERMARK_TEXT = "TG - @That_stuff"
 SCALE = 0.05  # 5% of the smaller video/image dimension
 MARGIN = 10   # px padding from edges for static placements
 
+# "overlay" composites a pre-rendered sprite of WATERMARK_TEXT; "drawtext"
+# rasterizes the text with FreeType on every frame (kept for comparison).
+WATERMARK_RENDERER = "overlay"
+SPRITE_CACHE_SIZE = 32  # rendered font sizes kept in memory per process
+sprite_folder = os.path.join(media_folder, "sprites")
+
 # Try to locate a common font file for both PIL and ffmpeg drawtext
 FONT_FILE_CANDIDATES = [
     "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
@@ -57,187 +246,1038 @@ for f in FONT_FILE_CANDIDATES:
         FONT_FILE = f
         break
 
+# ======== Async media tools ========
+encode_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ENCODES)
+image_pool = None
+
+def get_image_pool():
+    global image_pool
+    if image_pool is None:
+        image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return image_pool
+
+async def run_media_tool(cmd, timeout, input_chunks=None):
+    """
+    Run ffmpeg/ffprobe as an asyncio subprocess so the event loop keeps running.
+    If input_chunks (an async iterable of bytes) is given it is written to stdin.
+    Returns (returncode, stdout, stderr). The process is killed on timeout
+    (returncode -1), when the calling task is cancelled or when input_chunks fails.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL if input_chunks is None else asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    async def feed_stdin():
+        try:
+            async for chunk in input_chunks:
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the tool exited early; its return code says why
+        finally:
+            proc.stdin.close()
+
+    try:
+        if input_chunks is None:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        else:
+            _, (stdout, stderr) = await asyncio.wait_for(
+                asyncio.gather(feed_stdin(), proc.communicate()), timeout)
+    except BaseException as e:
+        if proc.returncode is None:
+            proc.kill()
+        await asyncio.shield(proc.wait())
+        if not isinstance(e, asyncio.TimeoutError):
+            raise
+        logger.error(f"[Tool Timeout] {cmd[0]} killed after {timeout}s")
+        return -1, "", f"timed out after {timeout}s"
+    return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+async def run_encode(cmd, input_chunks=None):
+    """Run an ffmpeg encode, capped at MAX_CONCURRENT_ENCODES at a time."""
+    async with encode_semaphore:
+        return await run_media_tool(cmd, FFMPEG_TIMEOUT, input_chunks)
+
+async def run_image_job(func, *args):
+    """Run a blocking Pillow function in the image process pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_image_pool(), func, *args)
+
 # ======== Utility / FFmpeg helpers ========
-def extract_video_info(file_path):
+def remove_files(*paths):
+    for f in paths:
+        if f and os.path.exists(f):
+            try:
+                os.remove(f)
+            except Exception:
+                pass
+
+async def extract_video_info(file_path):
+    """
+    Probe the first video stream. Width/height are display dimensions
+    (swapped for 90/270 degree rotated videos, since ffmpeg autorotates),
+    and duration falls back to the container duration when the stream has none.
+    """
     try:
         cmd = [
             "ffprobe", "-v", "error", "-select_streams", "v:0",
-            "-show_entries", "stream=width,height,duration",
+            "-show_entries", "stream=codec_name,width,height,duration,r_frame_rate:stream_tags=rotate:stream_side_data=rotation:format=duration,bit_rate",
             "-of", "json", file_path
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        data = json.loads(result.stdout or "{}")
+        _, stdout, _ = await run_media_tool(cmd, FFPROBE_TIMEOUT)
+        data = json.loads(stdout or "{}")
         if not data.get("streams"):
             return {}
         stream = data["streams"][0]
+        width = int(stream.get("width", 0))
+        height = int(stream.get("height", 0))
+        rotation = stream.get("tags", {}).get("rotate", 0)
+        for side_data in stream.get("side_data_list", []):
+            rotation = side_data.get("rotation", rotation)
+        if abs(int(float(rotation))) % 180 == 90:
+            width, height = height, width
+        duration = stream.get("duration") or data.get("format", {}).get("duration") or 0.0
+        rate_num, _, rate_den = stream.get("r_frame_rate", "0/1").partition("/")
+        fps = float(rate_num) / float(rate_den) if float(rate_den or 0) else 0.0
         return {
-            "width": int(stream.get("width", 0)),
-            "height": int(stream.get("height", 0)),
-            "duration": float(stream.get("duration", 0.0) or 0.0)
+            "codec": stream.get("codec_name", ""),
+            "width": width,
+            "height": height,
+            "duration": float(duration),
+            "fps": fps,
+            "bitrate": int(data.get("format", {}).get("bit_rate") or 0)
         }
     except Exception as e:
         logger.error(f"[FFprobe Error] {e}")
         return {}
 
-def extract_thumbnail(video_path, thumb_path):
-    try:
-        cmd = [
-            "ffmpeg", "-i", video_path, "-ss", "00:00:01.000", "-vframes", "1", thumb_path, "-y"
+# ======== Metrics ========
+class Metrics:
+    """
+    In-process counters, gauges and histograms rendered as Prometheus text.
+    Collectors are callables returning (name, type, labels, value) samples
+    that are read at scrape time, e.g. queue depths and cache statistics.
+    """
+
+    def __init__(self, buckets, trace_file=None):
+        self.buckets = buckets
+        self.counters = {}       # (name, labels) -> value
+        self.histograms = {}     # (name, labels) -> [bucket counts..., sum, count]
+        self.collectors = []
+        self.trace_file = trace_file
+        self.trace = None
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        hist = self.histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                hist[i] += 1
+        hist[-2] += value
+        hist[-1] += 1
+
+    def collector(self, func):
+        self.collectors.append(func)
+        return func
+
+    def span(self, name, job=None, **labels):
+        return Span(self, name, job, labels)
+
+    def write_trace(self, record):
+        if not self.trace_file:
+            return
+        if self.trace is None:
+            self.trace = open(self.trace_file, "a", encoding="utf-8")
+        self.trace.write(json.dumps(record) + "\n")
+        self.trace.flush()
+
+    def render(self):
+        def fmt(labels):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+        lines = []
+        typed = set()
+
+        def sample(name, kind, labels, value):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{fmt(labels)} {value}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            sample(name, "counter", labels, value)
+        for (name, labels), hist in sorted(self.histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for bound, count in zip((*self.buckets, "+Inf"), (*hist[:len(self.buckets)], hist[-1])):
+                lines.append(f"{name}_bucket{fmt(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{name}_sum{fmt(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{fmt(labels)} {hist[-1]}")
+        for collect in self.collectors:
+            for name, kind, labels, value in collect():
+                sample(name, kind, self._labels(labels), value)
+        return "\n".join(lines) + "\n"
+
+class Span:
+    """Times a block into the srp_span_seconds histogram; a block that raises counts as a failure."""
+
+    def __init__(self, metrics, name, job, labels):
+        self.metrics = metrics
+        self.name = name
+        self.job = job
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        self.clock = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.clock
+        ok = exc_type is None
+        self.metrics.observe("srp_span_seconds", duration, span=self.name, **self.labels)
+        if not ok and not issubclass(exc_type, asyncio.CancelledError):
+            self.metrics.inc("srp_failures_total", span=self.name)
+        self.metrics.write_trace({"job": self.job, "span": self.name, "start": round(self.started, 3),
+                                  "seconds": round(duration, 4), "ok": ok, **self.labels})
+
+metrics = Metrics(HISTOGRAM_BUCKETS, TRACE_FILE)
+
+async def serve_metrics():
+    """Answer every HTTP request on METRICS_HOST:METRICS_PORT with the current metrics."""
+    async def handle(reader, writer):
+        try:
+            while (await reader.readline()).strip():  # request line and headers
+                pass
+            body = metrics.render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"[Metrics] Request failed: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, METRICS_HOST, METRICS_PORT)
+    logger.info(f"[Metrics] Serving on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    async with server:
+        await server.serve_forever()
+
+# ======== Scratch space ========
+class Workspace:
+    """Scratch directories of one pipeline run, deleted with everything in them on exit."""
+
+    def __init__(self, name, shm_root):
+        self.dir = os.path.join(media_folder, name)
+        self.shm_dir = os.path.join(shm_root, name) if shm_root else None
+        for folder in (self.dir, self.shm_dir):
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+
+    def folder_for(self, size):
+        """tmpfs for files known to be small, disk otherwise."""
+        if self.shm_dir and 0 < size <= SCRATCH_SHM_MAX_BYTES:
+            return self.shm_dir
+        return self.dir
+
+    def close(self):
+        for folder in (self.dir, self.shm_dir):
+            if folder:
+                shutil.rmtree(folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ScratchSpace:
+    """
+    Hands out per-run workspaces and keeps the bytes of files in flight under
+    quota: reserve() waits until enough earlier items have released theirs.
+    """
+
+    def __init__(self, quota, shm_dir):
+        self.quota = quota
+        self.used = 0
+        self.changed = asyncio.Condition()
+        self.shm_root = os.path.join(shm_dir, "srp_media") if shm_dir and os.path.isdir(shm_dir) else None
+        self.runs = itertools.count(1)
+
+    def workspace(self, job_id=None):
+        name = f"job_{job_id}" if job_id is not None else f"run_{os.getpid()}_{next(self.runs)}"
+        return Workspace(name, self.shm_root)
+
+    def estimate(self, source_size):
+        return source_size * SCRATCH_SIZE_FACTOR
+
+    async def reserve(self, nbytes):
+        async with self.changed:
+            # An item bigger than the whole quota still runs, just on its own
+            await self.changed.wait_for(lambda: self.used == 0 or self.used + nbytes <= self.quota)
+            self.used += nbytes
+
+    async def release(self, nbytes):
+        if not nbytes:
+            return
+        async with self.changed:
+            self.used -= nbytes
+            self.changed.notify_all()
+
+    def sweep(self, keep=()):
+        """Delete workspaces and stray files left by earlier runs, except the named workspaces."""
+        for root in (media_folder, self.shm_root):
+            if not root or not os.path.isdir(root):
+                continue
+            for name in os.listdir(root):
+                path = os.path.join(root, name)
+                if name in keep or path == sprite_folder:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    remove_files(path)
+
+scratch = ScratchSpace(SCRATCH_QUOTA_BYTES, SCRATCH_SHM_DIR)
+metrics.collector(lambda: [("srp_scratch_reserved_bytes", "gauge", {}, scratch.used)])
+
+# ======== Request scheduler ========
+class TokenBucket:
+    """
+    Hands out tokens at rate per second (up to burst saved) to waiters in
+    priority order; rate None never runs out. block() holds every waiter
+    back, e.g. for a FloodWait.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+        self.blocked_until = 0.0
+        self.waiters = []         # heap of (priority, seq, future)
+        self.seq = itertools.count()
+        self.pump = None
+
+    async def acquire(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future))
+        if self.pump is None or self.pump.done():
+            self.pump = asyncio.ensure_future(self._serve())
+        await future
+
+    def block(self, seconds):
+        now = asyncio.get_running_loop().time()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def _delay(self):
+        now = asyncio.get_running_loop().time()
+        if self.rate is None:
+            return max(0.0, self.blocked_until - now)
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    async def _serve(self):
+        while self.waiters:
+            delay = self._delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self.waiters)
+            if future.done():  # caller was cancelled while queued
+                continue
+            if self.rate is not None:
+                self.tokens -= 1
+            future.set_result(None)
+
+class RequestScheduler:
+    """
+    Central gate for Telegram API calls: paces them with token buckets,
+    sleeps and retries on FloodWait, and counts the time lost to both.
+    """
+
+    def __init__(self, rate_limits, peer_rate_limit):
+        self.rate_limits = rate_limits
+        self.peer_rate_limit = peer_rate_limit
+        self.buckets = {}
+        self.on_flood_wait = None  # callback(account client, seconds)
+        self.calls = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.throttled_seconds = 0.0
+
+    def bucket(self, key, limit):
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(*limit)
+        return self.buckets[key]
+
+    def buckets_for(self, account, method, peer):
+        """Limits are per account: each one has its own flood limits with Telegram."""
+        limit = self.rate_limits.get(method)
+        if not limit:
+            # Unpaced methods still get a bucket so a FloodWait can hold them back
+            return [self.bucket((account, method, None), (None, 1))]
+        peer_key = getattr(peer, "id", peer)
+        return [self.bucket((account, method, peer_key), limit),
+                self.bucket((account, "*", peer_key), self.peer_rate_limit)]
+
+    async def call(self, func, *args, priority=PRIORITY_NORMAL, **kwargs):
+        """Await func(*args, **kwargs) once the buckets allow it; args[0] is the peer for client methods."""
+        method = getattr(func, "__name__", None) or type(args[0]).__name__  # client(request) -> request name
+        account = getattr(func, "__self__", func)  # client.method -> client; client(request) -> client
+        buckets = self.buckets_for(id(account), method, args[0] if args else None)
+        loop = asyncio.get_running_loop()
+        for attempt in range(FLOOD_WAIT_RETRIES + 1):
+            queued_at = loop.time()
+            for bucket in buckets:
+                await bucket.acquire(priority)
+            self.throttled_seconds += loop.time() - queued_at
+            self.calls += 1
+            try:
+                return await func(*args, **kwargs)
+            except errors.FloodWaitError as e:
+                if self.on_flood_wait:
+                    self.on_flood_wait(account, e.seconds)
+                if attempt == FLOOD_WAIT_RETRIES or e.seconds > FLOOD_WAIT_MAX:
+                    raise
+                self.flood_waits += 1
+                self.flood_wait_seconds += e.seconds
+                logger.warning(f"[FloodWait] {method}: waiting {e.seconds}s (retry {attempt + 1}/{FLOOD_WAIT_RETRIES})")
+                buckets[0].block(e.seconds)
+
+    def stats(self):
+        return (f"{self.calls} calls, {self.flood_waits} flood waits ({self.flood_wait_seconds}s), "
+                f"{self.throttled_seconds:.1f}s queued")
+
+api_scheduler = RequestScheduler(API_RATE_LIMITS, API_PEER_RATE_LIMIT)
+
+@metrics.collector
+def api_scheduler_metrics():
+    return [
+        ("srp_api_calls_total", "counter", {}, api_scheduler.calls),
+        ("srp_flood_waits_total", "counter", {}, api_scheduler.flood_waits),
+        ("srp_flood_wait_seconds_total", "counter", {}, api_scheduler.flood_wait_seconds),
+        ("srp_throttled_seconds_total", "counter", {}, round(api_scheduler.throttled_seconds, 3)),
+    ]
+
+def api_call(func, *args, priority=PRIORITY_NORMAL, **kwargs):
+    return api_scheduler.call(func, *args, priority=priority, **kwargs)
+
+# ======== Entity cache ========
+entity_cache = {}  # lowercased username -> (expires_at, entity or the future of its lookup)
+entity_cache_hits = 0
+
+async def resolve_entity(username, priority=PRIORITY_NORMAL):
+    """
+    client.get_entity through a cache kept for ENTITY_CACHE_TTL seconds.
+    Concurrent lookups of one username share a single call; failures aren't cached.
+    """
+    global entity_cache_hits
+    key = username.lower()
+    now = time.monotonic()
+    cached = entity_cache.get(key)
+    if cached and cached[0] > now:
+        entity_cache_hits += 1
+        entity = cached[1]
+        return await asyncio.shield(entity) if isinstance(entity, asyncio.Future) else entity
+    lookup = asyncio.ensure_future(api_call(client.get_entity, username, priority=priority))
+    entity_cache[key] = (now + ENTITY_CACHE_TTL, lookup)
+
+    def settle(future):
+        # Runs even when every caller was cancelled, so a failed lookup never stays cached
+        if entity_cache.get(key, (0, None))[1] is not future:
+            return
+        if future.cancelled() or future.exception():
+            entity_cache.pop(key)
+        else:
+            entity_cache[key] = (now + ENTITY_CACHE_TTL, future.result())
+
+    lookup.add_done_callback(settle)
+    return await asyncio.shield(lookup)
+
+metrics.collector(lambda: [("srp_entity_cache_hits_total", "counter", {}, entity_cache_hits)])
+
+# ======== Account pool ========
+class Account:
+    """One logged-in Telegram session and the transfer work assigned to it."""
+
+    def __init__(self, name, session_client=None):
+        self.name = name
+        self.session_client = session_client  # None for the main account
+        self.active = 0           # transfers in progress
+        self.bytes = 0            # bytes moved so far
+        self.throttled_until = 0.0
+        self.failures = 0         # failed health checks in a row
+        self.healthy = True
+
+    @property
+    def client(self):
+        return client if self.session_client is None else self.session_client
+
+    @property
+    def primary(self):
+        return self.session_client is None
+
+    @property
+    def available(self):
+        return self.healthy and time.monotonic() >= self.throttled_until
+
+class AccountPool:
+    """
+    The main account plus the workers from WORKER_ACCOUNTS_FILE. pick() hands
+    out the least-loaded account in rotation; a FloodWait takes an account out
+    until it expires, and WORKER_HEALTH_FAILURES failed checks until one passes.
+    """
+
+    def __init__(self):
+        self.primary = Account("primary")
+        self.accounts = [self.primary]
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                configs = json.load(fh)
+        except Exception as e:
+            logger.error(f"[Accounts] Could not read {path}: {e}")
+            return
+        for config in configs:
+            session_client = TelegramClient(config["session"], config.get("api_id", api_id),
+                                            config.get("api_hash", api_hash), flood_sleep_threshold=0)
+            self.accounts.append(Account(config.get("name", config["session"]), session_client))
+
+    @property
+    def workers(self):
+        return self.accounts[1:]
+
+    async def start(self):
+        """Connect the workers; ones without an authorized session are dropped."""
+        for account in self.workers:
+            try:
+                await account.client.connect()
+                if await account.client.is_user_authorized():
+                    logger.info(f"[Accounts] Worker {account.name} connected.")
+                    continue
+                logger.error(f"[Accounts] Worker {account.name} is not logged in; skipping it.")
+            except Exception as e:
+                logger.error(f"[Accounts] Worker {account.name} failed to connect: {e}")
+            self.accounts.remove(account)
+        api_scheduler.on_flood_wait = self.throttle
+        if self.workers:
+            asyncio.ensure_future(self.health_checks())
+
+    def named(self, name):
+        return next((a for a in self.accounts if a.name == name), self.primary)
+
+    def pick(self, candidates=None):
+        """The least-loaded available account among candidates (default: all)."""
+        candidates = [a for a in (candidates or self.accounts) if a.available] or [self.primary]
+        return min(candidates, key=lambda a: (a.active, a.bytes))
+
+    def take_out(self, account):
+        """Take a worker out of rotation after a failed transfer, until its next health check passes."""
+        if not account.primary and account.healthy:
+            account.healthy = False
+            logger.error(f"[Accounts] Worker {account.name} taken out of rotation.")
+
+    @contextlib.contextmanager
+    def lease(self, account, size=0):
+        account.active += 1
+        try:
+            yield account
+        finally:
+            account.active -= 1
+            account.bytes += size
+
+    def throttle(self, session_client, seconds):
+        for account in self.accounts:
+            if account.client is session_client:
+                account.throttled_until = max(account.throttled_until, time.monotonic() + seconds)
+                if self.workers:
+                    logger.warning(f"[Accounts] {account.name} out of rotation for {seconds}s (FloodWait).")
+
+    async def health_checks(self):
+        while True:
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL)
+            for account in self.workers:
+                try:
+                    if not account.client.is_connected():
+                        await account.client.connect()
+                    await asyncio.wait_for(api_call(account.client.get_me, priority=PRIORITY_BULK), REPLY_TIMEOUT)
+                    if not account.healthy:
+                        logger.info(f"[Accounts] Worker {account.name} is back in rotation.")
+                    account.failures = 0
+                    account.healthy = True
+                except Exception as e:
+                    account.failures += 1
+                    logger.warning(f"[Accounts] Health check of {account.name} failed ({account.failures}): {e}")
+                    if account.failures >= WORKER_HEALTH_FAILURES and account.healthy:
+                        account.healthy = False
+                        logger.error(f"[Accounts] Worker {account.name} taken out of rotation.")
+
+accounts = AccountPool()
+accounts.load(WORKER_ACCOUNTS_FILE)
+
+@metrics.collector
+def account_metrics():
+    samples = []
+    for account in accounts.accounts:
+        samples += [
+            ("srp_account_transfers", "gauge", {"account": account.name}, account.active),
+            ("srp_account_bytes_total", "counter", {"account": account.name}, account.bytes),
+            ("srp_account_available", "gauge", {"account": account.name}, int(account.available)),
         ]
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return os.path.exists(thumb_path)
-    except Exception as e:
-        logger.error(f"[Thumb Error] {e}")
-        return False
+    return samples
 
 # ======== Watermark functions ========
-def apply_video_watermark(input_path, output_path):
+def choose_watermark_motion(w, h):
+    """Pick the random movement direction and starting offset for a w x h video."""
+    return {
+        "direction": random.choice(["left_to_right", "right_to_left", "top_to_bottom", "bottom_to_top"]),
+        "start_x": random.randint(0, max(0, w // 4)),
+        "start_y": random.randint(0, max(0, h // 4)),
+    }
+
+def watermark_font_size(w, h):
+    # font size relative to the frame (use smaller dimension)
+    return max(8, int(min(w, h) * SCALE))
+
+def load_watermark_font(font_size):
+    # Load a TTF font if available, otherwise fallback to default
+    try:
+        if FONT_FILE:
+            return ImageFont.truetype(FONT_FILE, font_size)
+        return ImageFont.truetype("arial.ttf", font_size)
+    except Exception:
+        return ImageFont.load_default()
+
+sprite_cache = OrderedDict()  # font size -> RGBA sprite, least recently used first
+
+def get_watermark_sprite(font_size):
     """
-    Adds a moving text watermark using ffmpeg drawtext.
-    Movement direction and random starting offset are chosen randomly.
-    This function checks input file before running ffmpeg and logs stderr on failure.
+    Return WATERMARK_TEXT rendered once at font_size as a tightly cropped
+    white RGBA image. At most SPRITE_CACHE_SIZE sizes are kept.
     """
-    try:
-        # Safety checks: input must exist and be non-zero
-        if not os.path.exists(input_path) or os.path.getsize(input_path) == 0:
-            logger.error(f"[Skip] Input file missing or empty: {input_path}")
-            return input_path
+    sprite = sprite_cache.get(font_size)
+    if sprite is not None:
+        sprite_cache.move_to_end(font_size)
+        return sprite
+
+    font = load_watermark_font(font_size)
+    left, top, right, bottom = font.getbbox(WATERMARK_TEXT)
+    sprite = Image.new("RGBA", (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+    ImageDraw.Draw(sprite).text((-left, -top), WATERMARK_TEXT, font=font, fill=(255, 255, 255, 255))
+
+    sprite_cache[font_size] = sprite
+    while len(sprite_cache) > SPRITE_CACHE_SIZE:
+        sprite_cache.popitem(last=False)
+    return sprite
+
+def get_watermark_sprite_file(font_size):
+    """Return the path of the sprite PNG for font_size, rendering it on first use."""
+    text_key = hashlib.sha1(f"{WATERMARK_TEXT}|{FONT_FILE}".encode()).hexdigest()[:10]
+    path = os.path.join(sprite_folder, f"wm_{font_size}_{text_key}.png")
+    if not os.path.exists(path):
+        os.makedirs(sprite_folder, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        get_watermark_sprite(font_size).save(tmp_path, "PNG")
+        os.replace(tmp_path, path)
+    return path
+
+def build_watermark_filter(w, h, motion=None, time_offset=0.0):
+    """
+    Build the moving watermark filter for a w x h frame.
+    motion comes from choose_watermark_motion (a fresh random one if omitted).
+    time_offset shifts t so a segment that starts time_offset seconds into the
+    video continues the motion seamlessly.
+    Returns (filter, direction, extra_inputs): with the overlay renderer the
+    filter reads the sprite from input 1, so extra_inputs must follow the main
+    input on the ffmpeg command line.
+    """
+    font_size = watermark_font_size(w, h)
+
+    motion = motion or choose_watermark_motion(w, h)
+    direction = motion["direction"]
+    start_x = motion["start_x"]
+    start_y = motion["start_y"]
+    t = f"(t+{time_offset:.3f})" if time_offset else "t"
+
+    # Speed (t multiplier) - tuned so watermark moves at reasonable pace across sizes
+    horiz_speed = max(30, w // 6)
+    vert_speed = max(20, h // 8)
+
+    margin = 10
+    # TW/TH stand for the rendered text size; expressions are quoted so
+    # their commas don't split the filter graph
+    if direction == "left_to_right":
+        # text moves from left to right
+        x_expr = f"'mod({t}*{horiz_speed}+{start_x},{w}-TW-{margin})'"
+        y_expr = f"{start_y}"
+    elif direction == "right_to_left":
+        x_expr = f"'({w}-TW-{margin})-mod({t}*{horiz_speed}+{start_x},{w}-TW-{margin})'"
+        y_expr = f"{start_y}"
+    elif direction == "top_to_bottom":
+        x_expr = f"{start_x}"
+        y_expr = f"'mod({t}*{vert_speed}+{start_y},{h}-TH-{margin})'"
+    else:  # bottom_to_top
+        x_expr = f"{start_x}"
+        y_expr = f"'({h}-TH-{margin})-mod({t}*{vert_speed}+{start_y},{h}-TH-{margin})'"
+
+    if WATERMARK_RENDERER == "overlay":
+        position = f"x={x_expr}:y={y_expr}".replace("TW", "overlay_w").replace("TH", "overlay_h")
+        return f"overlay={position}", direction, ["-i", get_watermark_sprite_file(font_size)]
+
+    # Build font specification for ffmpeg drawtext
+    if FONT_FILE:
+        # use explicit fontfile if available (safer)
+        font_opts = f":fontfile='{FONT_FILE}':fontsize={font_size}:fontcolor=white"
+    else:
+        # fallback to font name
+        font_opts = f":font='Sans':fontsize={font_size}:fontcolor=white"
+    position = f"x={x_expr}:y={y_expr}".replace("TW", "text_w").replace("TH", "text_h")
+    return f"drawtext=text='{WATERMARK_TEXT}'{font_opts}:{position}", direction, []
 
-        info = extract_video_info(input_path)
-        if not info:
-            logger.warning("[Skip] Could not extract video info.")
-            return input_path
+def build_video_graph(w, h, vf_expr, duration, with_thumb):
+    """
+    Filter graph: scale to w x h, watermark, and optionally split off a
+    thumbnail frame. Outputs are labelled [vout] and [thumb]. An overlay
+    watermark takes its sprite from input 1.
+    """
+    if vf_expr.startswith("overlay"):
+        graph = f"[0:v]scale={w}:{h}[base];[base][1:v]{vf_expr},format=yuv420p"
+    else:
+        graph = f"[0:v]scale={w}:{h},{vf_expr},format=yuv420p"
+    if with_thumb:
+        thumb_at = min(1.0, duration / 2) if duration else 0.0
+        graph += f",split=2[vout][thumb_src];[thumb_src]select='gte(t,{thumb_at:.3f})'[thumb]"
+    else:
+        graph += "[vout]"
+    return graph
 
-        w = info["width"]
-        h = info["height"]
-        font_size = int(min(w, h) * SCALE)
-        if font_size < 8:
-            font_size = 8
+# Pixels per second libx264 manages at "medium"; starts as a guess and follows measured encodes
+encode_pixel_rate = 1920 * 1080 * 8 * (os.cpu_count() or 1)
 
-        # Remove existing output if any
-        try:
-            if os.path.exists(output_path):
-                os.remove(output_path)
-        except Exception:
-            pass
+def encoding_profile(name=None):
+    name = name or CHANNEL_PROFILES.get(target_channel_id, ENCODING_PROFILE)
+    return name, ENCODING_PROFILES.get(name, ENCODING_PROFILES["balanced"])
 
-        # Choose random direction
-        direction = random.choice(["left_to_right", "right_to_left", "top_to_bottom", "bottom_to_top"])
+def scaled_size(width, height, max_height):
+    """Even output dimensions with the short side at most max_height."""
+    short_side = min(width, height)
+    if max_height and short_side > max_height:
+        width, height = width * max_height / short_side, height * max_height / short_side
+    width, height = int(width), int(height)
+    return width - width % 2, height - height % 2
 
-        # Speed (t multiplier) - tuned so watermark moves at reasonable pace across sizes
-        horiz_speed = max(30, w // 6)
-        vert_speed = max(20, h // 8)
+def choose_encoding(info, profile_name=None):
+    """
+    Pick the libx264 settings for a probed video from the channel's profile
+    (or profile_name), the source bitrate and the configured size target and
+    time budget. Returns a dict with profile, preset, crf, maxrate_kbps, width and height.
+    """
+    name, profile = encoding_profile(profile_name)
+    duration = info.get("duration", 0.0)
+    preset = profile["preset"]
+    max_height = profile.get("max_height")
+    width, height = scaled_size(info["width"], info["height"], max_height)
+
+    caps = [profile.get("maxrate_kbps")]
+    if info.get("bitrate"):
+        caps.append(info["bitrate"] / 1000 * 1.1)  # re-encoding can't add detail the source doesn't have
+    if ENCODE_TARGET_MB and duration:
+        caps.append(max(100, ENCODE_TARGET_MB * 8192 / duration - ENCODE_AUDIO_KBPS))
+    caps = [cap for cap in caps if cap]
+    maxrate = int(min(caps)) if caps else None
+
+    if ENCODE_TIME_BUDGET and duration:
+        frames = duration * (info.get("fps") or 30)
+        presets = list(PRESET_SPEEDS)
+        sizes = [max_height] + [s for s in (720, 480) if not max_height or s < max_height]
+
+        def estimate(preset, width, height):
+            return frames * width * height / (encode_pixel_rate * PRESET_SPEEDS.get(preset, 1.0))
+
+        # Faster presets first, then smaller frames, until the estimate fits
+        for candidate in presets[presets.index(preset) if preset in presets else 0:]:
+            preset = candidate
+            if estimate(preset, width, height) <= ENCODE_TIME_BUDGET:
+                break
+        for size in sizes[1:]:
+            if estimate(preset, width, height) <= ENCODE_TIME_BUDGET:
+                break
+            width, height = scaled_size(info["width"], info["height"], size)
 
-        # start offsets (random)
-        start_x = random.randint(0, max(0, w // 4))
-        start_y = random.randint(0, max(0, h // 4))
+    return {"profile": name, "preset": preset, "crf": profile["crf"], "maxrate_kbps": maxrate,
+            "width": width, "height": height}
 
-        # Build font specification for ffmpeg drawtext
-        if FONT_FILE:
-            # use explicit fontfile if available (safer)
-            font_opts = f":fontfile='{FONT_FILE}':fontsize={font_size}:fontcolor=white"
-        else:
-            # fallback to font name
-            font_opts = f":font='Sans':fontsize={font_size}:fontcolor=white"
-
-        margin = 10
-        # Use text_w/text_h variables inside ffmpeg expressions
-        if direction == "left_to_right":
-            # text moves from left to right
-            vf_expr = (
-                f"drawtext=text='{WATERMARK_TEXT}'{font_opts}:"
-                f"x=mod(t*{horiz_speed}+{start_x},{w}-text_w-{margin}):"
-                f"y={start_y}"
-            )
-        elif direction == "right_to_left":
-            vf_expr = (
-                f"drawtext=text='{WATERMARK_TEXT}'{font_opts}:"
-                f"x=({w}-text_w-{margin})-mod(t*{horiz_speed}+{start_x},{w}-text_w-{margin}):"
-                f"y={start_y}"
-            )
-        elif direction == "top_to_bottom":
-            vf_expr = (
-                f"drawtext=text='{WATERMARK_TEXT}'{font_opts}:"
-                f"x={start_x}:"
-                f"y=mod(t*{vert_speed}+{start_y},{h}-text_h-{margin})"
-            )
-        else:  # bottom_to_top
-            vf_expr = (
-                f"drawtext=text='{WATERMARK_TEXT}'{font_opts}:"
-                f"x={start_x}:"
-                f"y=({h}-text_h-{margin})-mod(t*{vert_speed}+{start_y},{h}-text_h-{margin})"
-            )
+def x264_args(encoding):
+    args = ["-c:v", "libx264", "-preset", encoding["preset"], "-crf", str(encoding["crf"])]
+    if encoding.get("maxrate_kbps"):
+        args += ["-maxrate", f"{encoding['maxrate_kbps']}k", "-bufsize", f"{encoding['maxrate_kbps'] * 2}k"]
+    return args
 
+def build_video_command(input_spec, info, output_path, thumb_path=None, copy_audio=True, encoding=None):
+    """
+    Build the single-pass ffmpeg command for a probed input (a path or "pipe:0").
+    One filter graph scales to the encoding's even dimensions, draws the moving
+    watermark and splits off one frame for the thumbnail JPEG, so the input is
+    decoded once. encoding comes from choose_encoding (picked here when None).
+    Returns (cmd, output_info, direction).
+    """
+    encoding = encoding or choose_encoding(info)
+    w, h = encoding["width"], encoding["height"]
+    duration = info.get("duration", 0.0)
+
+    vf_expr, direction, extra_inputs = build_watermark_filter(w, h)
+    graph = build_video_graph(w, h, vf_expr, duration, bool(thumb_path))
+
+    cmd = [
+        "ffmpeg", "-v", "error", "-y", "-i", input_spec, *extra_inputs,
+        "-filter_complex", graph,
+        "-map", "[vout]", "-map", "0:a?",
+        *x264_args(encoding), "-c:a", "copy" if copy_audio else "aac",
+        "-movflags", "+faststart",
+        output_path
+    ]
+    if thumb_path:
+        cmd += ["-map", "[thumb]", "-frames:v", "1", thumb_path]
+    return cmd, {"width": w, "height": h, "duration": duration}, direction
+
+async def run_video_encode(cmd, output_path, thumb_path, input_chunks=None):
+    """
+    Run a command from build_video_command and validate what it wrote.
+    Returns (ok, thumb_path_or_None); failed outputs are removed.
+    """
+    remove_files(output_path, thumb_path)
+    returncode, _, stderr = await run_encode(cmd, input_chunks)
+    if returncode != 0:
+        logger.error(f"[FFmpeg Error] rc={returncode} stderr={stderr.strip()}")
+        remove_files(output_path, thumb_path)
+        return False, None
+
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        logger.error("[Overlay] FFmpeg finished but output missing or empty.")
+        remove_files(output_path, thumb_path)
+        return False, None
+
+    if thumb_path and not os.path.exists(thumb_path):
+        thumb_path = None
+    return True, thumb_path
+
+def record_encode(info, seconds, encoding):
+    """
+    Count encoded frames and encode time (their rates give the encode fps)
+    and fold the measured speed into encode_pixel_rate.
+    """
+    global encode_pixel_rate
+    frames = info.get("duration", 0) * info.get("fps", 0)
+    if frames and seconds > 0:
+        metrics.inc("srp_encoded_frames_total", round(frames), profile=encoding["profile"])
+        metrics.inc("srp_encode_seconds_total", seconds, profile=encoding["profile"])
+        measured = frames * encoding["width"] * encoding["height"] / seconds / PRESET_SPEEDS.get(encoding["preset"], 1.0)
+        encode_pixel_rate = 0.8 * encode_pixel_rate + 0.2 * measured
+        logger.info(f"[FFmpeg] Encoded at {frames / seconds:.1f} fps ({encoding['profile']}, {encoding['preset']})")
+
+def should_encode_parallel(info):
+    if not PARALLEL_ENCODE or PARALLEL_MAX_SEGMENTS < 2:
+        return False
+    return (info.get("duration", 0) >= PARALLEL_MIN_DURATION
+            and info["width"] * info["height"] >= PARALLEL_MIN_PIXELS)
+
+async def split_video_segments(input_path, work_dir, segment_seconds):
+    """
+    Stream-copy the video track into segments cut at keyframes.
+    Returns [(segment_path, start_seconds), ...] in order, or [] on failure.
+    """
+    list_path = os.path.join(work_dir, "segments.csv")
+    cmd = [
+        "ffmpeg", "-v", "error", "-y", "-i", input_path,
+        "-map", "0:v:0", "-c", "copy",
+        "-f", "segment", "-segment_time", f"{segment_seconds:.3f}",
+        "-reset_timestamps", "1",
+        "-segment_list", list_path, "-segment_list_type", "csv",
+        os.path.join(work_dir, "seg_%03d.mkv")
+    ]
+    returncode, _, stderr = await run_media_tool(cmd, FFMPEG_TIMEOUT)
+    if returncode != 0 or not os.path.exists(list_path):
+        logger.error(f"[Segment Error] rc={returncode} stderr={stderr.strip()}")
+        return []
+    segments = []
+    with open(list_path, "r", encoding="utf-8") as fh:
+        for line in fh:
+            parts = line.strip().rsplit(",", 2)
+            if len(parts) == 3:
+                segments.append((os.path.join(work_dir, os.path.basename(parts[0])), float(parts[1])))
+    return segments
+
+async def apply_video_watermark_parallel(input_path, output_path, thumb_path, info, copy_audio, encoding):
+    """
+    Watermark a long video by encoding keyframe-aligned segments concurrently.
+    Every segment shares one watermark motion and shifts t by its start time, so
+    the movement is continuous across cuts. The encoded segments are joined with
+    stream copy and the original audio is muxed back in.
+    Returns (ok, thumb_path_or_None, output_info).
+    """
+    w, h = encoding["width"], encoding["height"]
+    duration = info["duration"]
+    segment_count = max(2, min(PARALLEL_MAX_SEGMENTS, int(duration // PARALLEL_MIN_SEGMENT_SECONDS)))
+    work_dir = os.path.join(os.path.dirname(output_path), "par_" + os.path.splitext(os.path.basename(output_path))[0])
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        segments = await split_video_segments(input_path, work_dir, duration / segment_count)
+        if len(segments) < 2:
+            return False, None, {}
+
+        motion = choose_watermark_motion(w, h)
+        threads = max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_ENCODES)
+        logger.info(f"[FFmpeg] Watermarking {len(segments)} segments in parallel ({motion['direction']}) -> {output_path}")
+
+        async def encode_segment(index, segment_path, start):
+            vf_expr, _, extra_inputs = build_watermark_filter(w, h, motion, time_offset=start)
+            # Only the first segment produces the thumbnail
+            seg_thumb = thumb_path if index == 0 else None
+            seg_out = os.path.join(work_dir, f"wm_{index:03d}.mkv")
+            cmd = [
+                "ffmpeg", "-v", "error", "-y", "-i", segment_path, *extra_inputs,
+                "-filter_complex", build_video_graph(w, h, vf_expr, duration, bool(seg_thumb)),
+                "-map", "[vout]", *x264_args(encoding), "-threads", str(threads),
+                seg_out
+            ]
+            if seg_thumb:
+                cmd += ["-map", "[thumb]", "-frames:v", "1", seg_thumb]
+            ok, seg_thumb = await run_video_encode(cmd, seg_out, seg_thumb)
+            return ok, seg_out, seg_thumb
+
+        results = await asyncio.gather(*(encode_segment(i, path, start) for i, (path, start) in enumerate(segments)))
+        if not all(ok for ok, _, _ in results):
+            return False, None, {}
+
+        concat_list = os.path.join(work_dir, "concat.txt")
+        with open(concat_list, "w", encoding="utf-8") as fh:
+            for _, seg_out, _ in results:
+                fh.write(f"file '{os.path.abspath(seg_out)}'\n")
         cmd = [
-            "ffmpeg", "-i", input_path,
-            "-vf", vf_expr,
-            "-c:a", "copy",
+            "ffmpeg", "-v", "error", "-y",
+            "-f", "concat", "-safe", "0", "-i", concat_list,
+            "-i", input_path,
+            "-map", "0:v", "-map", "1:a?",
+            "-c:v", "copy", "-c:a", "copy" if copy_audio else "aac",
             "-movflags", "+faststart",
-            output_path,
-            "-y"
+            output_path
         ]
+        ok, _ = await run_video_encode(cmd, output_path, None)
+        if not ok:
+            return False, None, {}
+        return True, results[0][2], {"width": w, "height": h, "duration": duration}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+async def apply_video_watermark(input_path, output_path, thumb_path=None, info=None, profile_name=None):
+    """
+    Convert to MP4, watermark and thumbnail a video or GIF in one ffmpeg pass.
+    info is the input's probe when the caller already has it; profile_name
+    overrides the channel's encoding profile.
+    Returns (final_path, thumb_path_or_None, info) with the output width, height
+    and duration in info. On failure the input path is returned unchanged.
+    """
+    try:
+        # Safety checks: input must exist and be non-zero
+        if not os.path.exists(input_path) or os.path.getsize(input_path) == 0:
+            logger.error(f"[Skip] Input file missing or empty: {input_path}")
+            return input_path, None, {}
 
-        logger.info(f"[FFmpeg] Watermarking video ({direction}) -> {output_path}")
-        proc = subprocess.run(cmd, capture_output=True, text=True)
-        if proc.returncode != 0:
-            logger.error(f"[FFmpeg Error] rc={proc.returncode} stderr={proc.stderr.strip()}")
-            # remove any zero-byte output
-            try:
-                if os.path.exists(output_path) and os.path.getsize(output_path) == 0:
-                    os.remove(output_path)
-            except Exception:
-                pass
-            return input_path
-
-        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-            return output_path
-        else:
-            logger.error("[Overlay] FFmpeg finished but output missing or empty.")
-            return input_path
+        info = info or await extract_video_info(input_path)
+        if not info or not info["width"] or not info["height"]:
+            logger.warning("[Skip] Could not extract video info.")
+            return input_path, None, info
+
+        # mp4/mov audio can be copied; other containers may carry codecs mp4 can't hold
+        copy_audio = os.path.splitext(input_path)[1].lower() in (".mp4", ".mov", ".m4v")
+
+        encoding = choose_encoding(info, profile_name)
+        logger.info(f"[Encode] {encoding['profile']}: {encoding['preset']} crf {encoding['crf']} "
+                    f"{encoding['width']}x{encoding['height']} maxrate {encoding['maxrate_kbps'] or '-'}k")
+        started = time.perf_counter()
+        if should_encode_parallel(info):
+            with metrics.span("encode", mode="parallel"):
+                ok, par_thumb, out_info = await apply_video_watermark_parallel(
+                    input_path, output_path, thumb_path, info, copy_audio, encoding)
+            if ok:
+                record_encode(info, time.perf_counter() - started, encoding)
+                return output_path, par_thumb, out_info
+            logger.warning("[Parallel] Segment encode failed; falling back to a single pass.")
+
+        cmd, out_info, direction = build_video_command(input_path, info, output_path, thumb_path, copy_audio, encoding)
 
+        logger.info(f"[FFmpeg] Watermarking video ({direction}) -> {output_path}")
+        with metrics.span("encode", mode="single"):
+            ok, thumb_path = await run_video_encode(cmd, output_path, thumb_path)
+        if not ok:
+            return input_path, None, info
+        record_encode(info, time.perf_counter() - started, encoding)
+        return output_path, thumb_path, out_info
+
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         logger.error(f"[Video Watermark Error] {e}")
-        return input_path
+        return input_path, None, {}
 
-def apply_image_watermark(input_path, output_path):
+def apply_image_watermark(input_path, output_path, keep_quality=False):
     """
-    Adds two static white text watermarks at random positions on images using PIL.
+    Adds two static white text watermarks at random positions on images.
+    The text comes from the cached sprite and is alpha-composited onto just
+    the two small regions it covers. JPEGs larger than IMAGE_MAX_SIDE are
+    decoded at a reduced scale (Telegram downsizes photos to that anyway), and
+    keep_quality re-saves an RGB JPEG with its own quantization tables.
+    Blocking; async code should go through watermark_image instead.
     """
     try:
         if not os.path.exists(input_path) or os.path.getsize(input_path) == 0:
             logger.error(f"[Skip Image] Input file missing or empty: {input_path}")
             return input_path
 
-        image = Image.open(input_path).convert("RGBA")
-        draw = ImageDraw.Draw(image)
+        image = Image.open(input_path)
+        source_format = image.format
+        if source_format == "JPEG" and max(image.size) > IMAGE_MAX_SIDE:
+            ratio = IMAGE_MAX_SIDE / max(image.size)
+            image.draft("RGB", (math.ceil(image.width * ratio), math.ceil(image.height * ratio)))
+            keep_quality = False  # the quantization tables belong to the full-size image
+        # Only RGB JPEGs can be re-saved with their own tables; L/CMYK ones are converted below
+        quant_source = image if keep_quality and source_format == "JPEG" and image.mode == "RGB" else None
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
 
-        # font size relative to the image (use smaller dimension)
-        font_size = int(min(image.width, image.height) * SCALE)
-        if font_size < 8:
-            font_size = 8
-
-        # Load a TTF font if available, otherwise fallback to default
-        try:
-            if FONT_FILE:
-                font = ImageFont.truetype(FONT_FILE, font_size)
-            else:
-                font = ImageFont.truetype("arial.ttf", font_size)
-        except Exception:
-            font = ImageFont.load_default()
-
-        text = WATERMARK_TEXT
-        text_w, text_h = draw.textsize(text, font=font)
+        sprite = get_watermark_sprite(watermark_font_size(image.width, image.height))
+        text_w, text_h = sprite.size
 
         # safe bounds
-        max_x = max(0, image.width - text_w - MARGIN)
-        max_y = max(0, image.height - text_h - MARGIN)
+        max_x = max(MARGIN, image.width - text_w - MARGIN)
+        max_y = max(MARGIN, image.height - text_h - MARGIN)
 
         # pick two distinct positions
         positions = []
         attempts = 0
         while len(positions) < 2 and attempts < 20:
-            x = random.randint(MARGIN, max_x or MARGIN)
-            y = random.randint(MARGIN, max_y or MARGIN)
+            x = random.randint(MARGIN, max_x)
+            y = random.randint(MARGIN, max_y)
             # avoid placing two too close
             if all(not (abs(x - px) < text_w // 2 and abs(y - py) < text_h // 2) for px, py in positions):
                 positions.append((x, y))
@@ -245,16 +1285,22 @@ def apply_image_watermark(input_path, output_path):
         if len(positions) < 2:
             positions = [(MARGIN, MARGIN), (max_x, max_y)]
 
-        # draw the text (white, full opacity, no shadow)
+        # composite the text (white, full opacity, no shadow) region by region
         for (x, y) in positions:
-            draw.text((x, y), text, font=font, fill=(255, 255, 255, 255))
+            box = (x, y, x + text_w, y + text_h)
+            region = image.crop(box).convert("RGBA")
+            region.alpha_composite(sprite)
+            image.paste(region if image.mode == "RGBA" else region.convert(image.mode), box)
 
         # Save as JPEG/PNG depending on original extension
         base_ext = os.path.splitext(output_path)[1].lower()
         if base_ext == ".png":
             image.save(output_path, "PNG")
+        elif quant_source is not None:
+            image.save(output_path, "JPEG", qtables=quant_source.quantization,
+                       subsampling=JpegImagePlugin.get_sampling(quant_source))
         else:
-            image.convert("RGB").save(output_path, "JPEG", quality=95)
+            (image if image.mode == "RGB" else image.convert("RGB")).save(output_path, "JPEG", quality=95)
 
         return output_path
 
@@ -262,17 +1308,332 @@ def apply_image_watermark(input_path, output_path):
         logger.error(f"[Image Watermark Error] {e}")
         return input_path
 
+async def watermark_image(input_path, output_path, keep_quality=False):
+    """Run apply_image_watermark in the image process pool."""
+    try:
+        return await run_image_job(apply_image_watermark, input_path, output_path, keep_quality)
+    except Exception as e:
+        logger.error(f"[Image Pool Error] {e}")
+        return input_path
+
+# ======== Dedup cache ========
+class MediaCache:
+    """
+    Persistent LRU map from source media to the watermarked copy already uploaded.
+    Entries are reachable by Telegram media id ("doc:<id>"/"photo:<id>") and by
+    the SHA-256 of the downloaded bytes ("sha:<hex>"); videos are also keyed by
+    the SHA-256 of the watermarked file we uploaded ("wm:<hex>"). Each entry keeps the
+    uploaded InputDocument/InputPhoto reference (valid for the account that
+    posted it), the channel message it was sent in and its probe attributes, and is evicted by count and source bytes.
+    """
+
+    def __init__(self, path, max_entries, max_bytes):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # primary key -> entry, oldest first
+        self.aliases = {}             # any key -> primary key
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False  # entries changed since the last save
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                stored = json.load(fh)
+        except Exception as e:
+            logger.error(f"[Cache Error] Could not read {self.path}: {e}")
+            return
+        for entry in stored:
+            self._insert(entry)
+        self._evict()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as fh:
+                json.dump(list(self.entries.values()), fh)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"[Cache Error] Could not write {self.path}: {e}")
+
+    def flush(self):
+        """Write the cache to disk if anything changed; called once per pipeline run."""
+        if self.dirty:
+            self.dirty = False
+            self.save()
+
+    def get(self, keys, count_miss=True):
+        """Return the entry for the first known key (refreshing its LRU slot) or None."""
+        for key in keys:
+            primary = self.aliases.get(key)
+            if primary:
+                self.entries.move_to_end(primary)
+                self.hits += 1
+                return self.entries[primary]
+        if count_miss:
+            self.misses += 1
+        return None
+
+    def put(self, keys, sent_msg, info, size, account="primary"):
+        """Remember the media of sent_msg (posted by the named account) under every key in keys."""
+        keys = [k for k in keys if k]
+        media = sent_msg.photo or sent_msg.document
+        if not keys or not media:
+            return
+        self.discard(keys)
+        self._insert({
+            "keys": keys,
+            "kind": "photo" if sent_msg.photo else "document",
+            "id": media.id,
+            "access_hash": media.access_hash,
+            "file_reference": media.file_reference.hex(),
+            "msg_id": sent_msg.id,
+            "account": account,
+            "album": bool(sent_msg.photo or sent_msg.video),
+            "info": info or {},
+            "size": size or 0,
+        })
+        self._evict()
+        self.dirty = True
+
+    def add_keys(self, entry, keys):
+        """Make entry reachable under extra keys, e.g. a new document id for known bytes."""
+        primary = entry["keys"][0]
+        for key in keys:
+            if key not in self.aliases:
+                entry["keys"].append(key)
+                self.aliases[key] = primary
+        self.dirty = True
+
+    def discard(self, keys):
+        for key in keys:
+            primary = self.aliases.get(key)
+            if primary:
+                self._remove(primary)
+                self.dirty = True
+
+    def input_media(self, entry):
+        """Build the InputPhoto/InputDocument that re-sends entry without uploading."""
+        cls = InputPhoto if entry["kind"] == "photo" else InputDocument
+        return cls(id=entry["id"], access_hash=entry["access_hash"],
+                   file_reference=bytes.fromhex(entry["file_reference"]))
+
+    def stats(self):
+        return f"{len(self.entries)} entries, {self.hits} hits, {self.misses} misses"
+
+    def _insert(self, entry):
+        primary = entry["keys"][0]
+        self.entries[primary] = entry
+        self.total_bytes += entry.get("size", 0)
+        for key in entry["keys"]:
+            self.aliases[key] = primary
+
+    def _remove(self, primary):
+        entry = self.entries.pop(primary, None)
+        if not entry:
+            return
+        self.total_bytes -= entry.get("size", 0)
+        for key in entry["keys"]:
+            self.aliases.pop(key, None)
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+
+media_cache = MediaCache(MEDIA_CACHE_FILE, MEDIA_CACHE_MAX_ENTRIES, MEDIA_CACHE_MAX_BYTES)
+
+@metrics.collector
+def media_cache_metrics():
+    return [
+        ("srp_cache_lookups_total", "counter", {"result": "hit"}, media_cache.hits),
+        ("srp_cache_lookups_total", "counter", {"result": "miss"}, media_cache.misses),
+        ("srp_cache_entries", "gauge", {}, len(media_cache.entries)),
+    ]
+
+def media_cache_keys(media_obj):
+    document = getattr(media_obj, "document", None)
+    if document:
+        return [f"doc:{document.id}"]
+    photo = getattr(media_obj, "photo", None)
+    if photo:
+        return [f"photo:{photo.id}"]
+    return []
+
+def media_source_size(media_obj):
+    document = getattr(media_obj, "document", None)
+    if document:
+        return document.size or 0
+    # Photos: the largest size Telegram has (progressive sizes list their scans)
+    photo = getattr(media_obj, "photo", None)
+    sizes = [max(s.sizes) if getattr(s, "sizes", None) else getattr(s, "size", 0) or 0
+             for s in getattr(photo, "sizes", None) or []]
+    return max(sizes, default=0)
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ======== Job journal ========
+class JobJournal:
+    """
+    SQLite record of fetch sessions (jobs) and the stage each of their items
+    reached. Job states: collecting -> posting -> posted -> linked -> done
+    (or failed). Item stages: collected -> downloaded -> watermarked -> uploaded.
+    """
+
+    UNFINISHED = ("collecting", "posting", "posted", "linked")
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bot_username TEXT, file_id TEXT, post_msg_id INTEGER, caption TEXT,
+                state TEXT, link TEXT, created REAL, updated REAL
+            );
+            CREATE TABLE IF NOT EXISTS items (
+                job_id INTEGER, idx INTEGER, media_key TEXT, source_chat_id INTEGER, source_msg_id INTEGER,
+                stage TEXT, file_path TEXT, processed_file TEXT, thumb_file TEXT, info TEXT, sent_msg_id INTEGER,
+                PRIMARY KEY (job_id, idx)
+            );
+        """)
+        self.db.commit()
+
+    def start_job(self, session):
+        now = time.time()
+        cursor = self.db.execute(
+            "INSERT INTO jobs (bot_username, file_id, post_msg_id, caption, state, created, updated) "
+            "VALUES (?, ?, ?, ?, 'collecting', ?, ?)",
+            (session.bot_username, session.file_id, session.original_msg.id, session.original_caption, now, now))
+        self.db.commit()
+        return cursor.lastrowid
+
+    def set_state(self, job_id, state, link=None):
+        if job_id is None:
+            return
+        self.db.execute("UPDATE jobs SET state = ?, link = COALESCE(?, link), updated = ? WHERE id = ?",
+                        (state, link, time.time(), job_id))
+        if state in ("done", "failed"):
+            # Finished jobs keep their row for history; item progress is no longer needed
+            self.db.execute("DELETE FROM items WHERE job_id = ?", (job_id,))
+        self.db.commit()
+
+    def add_item(self, job_id, index, media_key, source_chat_id, source_msg_id):
+        if job_id is None:
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO items (job_id, idx, media_key, source_chat_id, source_msg_id, stage) "
+            "VALUES (?, ?, ?, ?, ?, 'collected')",
+            (job_id, index, media_key, source_chat_id, source_msg_id))
+        self.db.commit()
+
+    def set_item_stage(self, job_id, index, stage, **fields):
+        """Record that item index reached stage; fields are file paths, info or sent_msg_id."""
+        if job_id is None:
+            return
+        if "info" in fields:
+            fields["info"] = json.dumps(fields["info"])
+        columns = "".join(f", {name} = ?" for name in fields)
+        self.db.execute(f"UPDATE items SET stage = ?{columns} WHERE job_id = ? AND idx = ?",
+                        (stage, *fields.values(), job_id, index))
+        self.db.commit()
+
+    def unfinished_jobs(self):
+        return self.db.execute(
+            f"SELECT * FROM jobs WHERE state IN ({','.join('?' * len(self.UNFINISHED))}) ORDER BY id",
+            self.UNFINISHED).fetchall()
+
+    def items(self, job_id):
+        return self.db.execute("SELECT * FROM items WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+
+    def clear_items(self, job_id):
+        self.db.execute("DELETE FROM items WHERE job_id = ?", (job_id,))
+        self.db.commit()
+
+journal = JobJournal(JOURNAL_FILE)
+
 # ======== Media Processing ========
-async def process_media(media_obj):
+def document_file_name(document):
+    """Local file name for a document: its id plus the original name or a mime-based extension."""
+    for attr in document.attributes:
+        if isinstance(attr, DocumentAttributeFilename) and attr.file_name:
+            return f"{document.id}_{os.path.basename(attr.file_name)}"
+    return f"{document.id}{utils.get_extension(document)}"
+
+async def parallel_download_file(document, file_path, session_client):
     """
-    Download media, convert GIF->MP4 if needed, apply watermark,
-    and return (final_file_path, thumb_path_or_None) ready to send.
-    This version validates downloads and returns (None, None) when download fails.
+    Fetch document in DOWNLOAD_CONNECTIONS byte ranges at once and write each
+    range into its place in a preallocated file. iter_download resolves the
+    document's DC, so files stored on another DC come from there.
+    """
+    size = document.size
+    range_size = -(-size // DOWNLOAD_CONNECTIONS)
+    range_size = -(-range_size // DOWNLOAD_REQUEST_SIZE) * DOWNLOAD_REQUEST_SIZE  # keep offsets request-aligned
+
+    with open(file_path, "wb") as fh:
+        fh.truncate(size)
+
+    async def fetch_range(start):
+        length = min(range_size, size - start)
+        with open(file_path, "r+b") as fh:
+            fh.seek(start)
+            async for chunk in session_client.iter_download(
+                document, offset=start, limit=-(-length // DOWNLOAD_REQUEST_SIZE),
+                request_size=DOWNLOAD_REQUEST_SIZE, file_size=size,
+            ):
+                chunk = chunk[:length]
+                fh.write(chunk)
+                length -= len(chunk)
+                if length <= 0:
+                    break
+        if length > 0:
+            raise RuntimeError(f"range at {start} ended {length} bytes short")
+
+    tasks = [asyncio.ensure_future(fetch_range(start)) for start in range(0, size, range_size)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other ranges before the caller deletes the partial file
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return file_path
+
+async def download_media_file(media_obj, folder=media_folder, session_client=None):
     """
-    file_path = await client.download_media(media_obj, file=media_folder)
+    Download media into folder and return the local path.
+    Large documents use parallel_download_file; everything else, and any
+    parallel download that fails, goes through client.download_media.
+    session_client is the account media_obj was fetched with (default: the main one).
+    Returns None when the download fails or produces an empty file.
+    """
+    session_client = session_client or client
+    document = getattr(media_obj, "document", None)
+    if DOWNLOAD_CONNECTIONS > 1 and document and (document.size or 0) >= PARALLEL_DOWNLOAD_MIN_BYTES:
+        file_path = os.path.join(folder, document_file_name(document))
+        try:
+            logger.info(f"[Download] {document.id}: {document.size} bytes over {DOWNLOAD_CONNECTIONS} connections")
+            await parallel_download_file(document, file_path, session_client)
+            metrics.inc("srp_bytes_total", document.size, direction="in")
+            return file_path
+        except Exception as e:
+            logger.warning(f"[Download] Parallel download of {document.id} failed ({e}); using a single stream.")
+            remove_files(file_path)
+
+    file_path = await api_call(session_client.download_media, media_obj, file=folder, priority=PRIORITY_BULK)
     if not file_path:
         logger.error("[Download Error] download_media returned no path.")
-        return None, None
+        return None
 
     # If download returned a directory, pick newest file inside
     if os.path.isdir(file_path):
@@ -281,89 +1642,765 @@ async def process_media(media_obj):
 
     if not file_path or not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
         logger.error(f"[Download Error] File not found or empty after download: {file_path}")
-        return None, None
+        return None
 
-    ext = os.path.splitext(file_path)[1].lower()
-    is_video = False
-    is_gif = False
+    metrics.inc("srp_bytes_total", os.path.getsize(file_path), direction="in")
+    return file_path
 
-    if hasattr(media_obj, "document") and media_obj.document:
-        for attr in media_obj.document.attributes:
-            if isinstance(attr, DocumentAttributeVideo):
-                is_video = True
+async def download_sharded(media_obj, folder, size, message=None):
+    """
+    Download media_obj on the least-loaded account. A worker can't open the
+    main account's messages, so message (the one carrying media_obj) is
+    forwarded to WORKER_STAGING_CHAT and the worker downloads its own copy of
+    that. Small files, media without its message, or no staging chat stay on
+    the main account, which is also the fallback.
+    """
+    shardable = (WORKER_STAGING_CHAT and accounts.workers and message is not None
+                 and size >= PARALLEL_DOWNLOAD_MIN_BYTES)
+    account = accounts.pick() if shardable else accounts.primary
+    if not account.primary:
+        staged = None
+        with accounts.lease(account):
+            try:
+                staged = await api_call(client.forward_messages, WORKER_STAGING_CHAT, message.id,
+                                        from_peer=message.chat_id, priority=PRIORITY_BULK)
+                worker_copy = await api_call(account.client.get_messages, WORKER_STAGING_CHAT, ids=staged.id,
+                                             priority=PRIORITY_BULK)
+                if worker_copy and worker_copy.media:
+                    logger.info(f"[Accounts] Downloading {size} bytes on {account.name}")
+                    file_path = await download_media_file(worker_copy, folder, account.client)
+                    if file_path:
+                        account.bytes += size
+                        return file_path
+            except Exception as e:
+                logger.warning(f"[Accounts] Download on {account.name} failed ({e}); using the main account.")
+            finally:
+                if staged:
+                    try:
+                        await api_call(client.delete_messages, WORKER_STAGING_CHAT, [staged.id],
+                                       priority=PRIORITY_BULK)
+                    except Exception as e:
+                        logger.warning(f"[Accounts] Could not delete staged message {staged.id}: {e}")
+    with accounts.lease(accounts.primary, size):
+        return await download_media_file(media_obj, folder)
+
+def stream_media_info(media_obj):
+    """
+    Return width/height/duration/bitrate from the document attributes when media_obj
+    is a large enough video to stream into ffmpeg, otherwise None. Videos that
+    qualify for the parallel segment encode are not streamed: a pipe can't be
+    split, and on a multi-core host the parallel encode is the faster of the two.
+    """
+    document = getattr(media_obj, "document", None)
+    if not STREAM_DOWNLOADS or not document or (document.size or 0) < STREAM_MIN_BYTES:
+        return None
+    if document.mime_type not in STREAMABLE_MIME_TYPES:
+        return None
+    for attr in document.attributes:
+        if isinstance(attr, DocumentAttributeVideo) and attr.w and attr.h:
+            duration = float(attr.duration or 0)
+            bitrate = int(document.size * 8 / duration) if duration else 0
+            info = {"width": attr.w, "height": attr.h, "duration": duration, "bitrate": bitrate}
+            return None if should_encode_parallel(info) else info
+    return None
 
-    if ext == ".gif":
-        is_gif = True
+def mp4_moov_first(head):
+    """
+    Walk the top-level MP4 boxes in head. True when 'moov' comes before 'mdat'
+    so ffmpeg can read the file from a pipe; False when 'mdat' comes first or
+    the layout can't be determined from head.
+    """
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], "big")
+        box_type = head[offset + 4:offset + 8]
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False
+        if size == 1:
+            if offset + 16 > len(head):
+                return False
+            size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if size < 8:
+            return False
+        offset += size
+    return False
+
+async def stream_media_file(media_obj, info, digest, folder=media_folder):
+    """
+    Watermark a video while it downloads by feeding iter_download chunks into ffmpeg's stdin.
+    digest (a hashlib object) is updated with every byte received.
+    Returns (final_path, thumb_path, info, None) on success. MP4/MOV files whose
+    moov atom comes after mdat can't be read from a pipe, so their download
+    continues to disk and (None, None, {}, file_path) is returned for the normal
+    on-disk path; the same happens, via a fresh download, when the stream or its
+    encode fails. file_path is None if no usable file could be downloaded.
+    """
+    document = media_obj.document
+    chunks = client.iter_download(document, request_size=STREAM_CHUNK_SIZE)
+    file_path = os.path.join(folder, f"{document.id}{utils.get_extension(media_obj) or '.mp4'}")
+    output_path = os.path.join(folder, f"wm_{document.id}.mp4")
+    thumb_path = os.path.join(folder, f"wm_{document.id}_thumb.jpg")
+
+    async def all_chunks():
+        yield head
+        async for chunk in chunks:
+            digest.update(chunk)
+            metrics.inc("srp_bytes_total", len(chunk), direction="in")
+            yield chunk
 
-    # If GIF, convert to MP4 first
-    if is_gif:
-        logger.info(f"Converting GIF -> MP4: {file_path}")
-        mp4_path = os.path.join(media_folder, f"{os.path.splitext(os.path.basename(file_path))[0]}.mp4")
-        cmd = [
-            "ffmpeg", "-i", file_path,
-            "-movflags", "+faststart",
-            "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
-            "-pix_fmt", "yuv420p",
-            mp4_path, "-y"
-        ]
-        proc = subprocess.run(cmd, capture_output=True, text=True)
-        if proc.returncode != 0 or not os.path.exists(mp4_path) or os.path.getsize(mp4_path) == 0:
-            logger.error(f"[GIF->MP4 Error] rc={proc.returncode} stderr={proc.stderr.strip()}")
-            return None, None
-        try:
-            os.remove(file_path)
-        except Exception:
-            pass
-        file_path = mp4_path
-        is_video = True
-        ext = ".mp4"
-
-    # Re-check extension if video after conversion
-    if not is_video and ext in [".mp4", ".mkv", ".mov", ".webm", ".avi"]:
-        is_video = True
-
-    if is_video:
-        logger.info(f"Processing video: {file_path}")
-        watermarked_path = os.path.join(media_folder, f"wm_{os.path.basename(file_path)}")
-        final_video = apply_video_watermark(file_path, watermarked_path)
+    try:
+        head = await chunks.__anext__()
+        digest.update(head)
+        metrics.inc("srp_bytes_total", len(head), direction="in")
+
+        if document.mime_type in ("video/mp4", "video/quicktime") and not mp4_moov_first(head):
+            logger.info(f"[Stream] moov atom not at start of {document.id}; downloading to disk.")
+            with open(file_path, "wb") as fh:
+                async for chunk in all_chunks():
+                    fh.write(chunk)
+            return None, None, {}, file_path
+
+        copy_audio = document.mime_type in ("video/mp4", "video/quicktime")
+        cmd, out_info, direction = build_video_command("pipe:0", info, output_path, thumb_path, copy_audio)
+
+        logger.info(f"[FFmpeg] Streaming watermark ({direction}) -> {output_path}")
+        ok, thumb_path = await run_video_encode(cmd, output_path, thumb_path, all_chunks())
+        if ok:
+            return output_path, thumb_path, out_info, None
+        logger.warning(f"[Stream] Streaming encode failed for {document.id}; retrying from disk.")
+    except Exception as e:
+        # A GetFile FloodWait or dropped connection mid-stream: start over with a plain download
+        logger.warning(f"[Stream] Streaming {document.id} failed ({e}); retrying from disk.")
+        remove_files(file_path, output_path, thumb_path)
+
+    with contextlib.suppress(Exception):
+        await chunks.close()  # hand back the exported DC sender of an unfinished download
+    return None, None, {}, await download_media_file(media_obj, folder)
+
+def probe_image(file_path):
+    """Read an image's header; returns {"format", "width", "height"} or {} when Pillow can't."""
+    try:
+        with Image.open(file_path) as image:
+            return {"format": image.format, "width": image.width, "height": image.height}
+    except Exception:
+        return {}
+
+async def classify_media(media_obj, file_path):
+    """
+    Decide how much work a downloaded file needs from its type, size, codec,
+    resolution and duration. Returns (route, info):
+      "video"       full watermark encode with the channel's profile
+      "clip"        short, small video: encoded with SHORT_CLIP_PROFILE
+      "gif"         converted to MP4 in the watermark pass
+      "image"       watermarked and re-saved at quality 95
+      "small-image" watermarked, keeping the JPEG's own quality tables
+      "passthrough" nothing we can decode; posted as downloaded
+    info is the video probe or the image header.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    document = getattr(media_obj, "document", None)
+    is_video = ext in (".mp4", ".mkv", ".mov", ".webm", ".avi") or bool(document and any(
+        isinstance(attr, DocumentAttributeVideo) for attr in document.attributes))
+
+    if ext == ".gif" or is_video:
+        info = await extract_video_info(file_path)
+        if ext == ".gif":
+            return "gif", info
+        if not info or not info["width"] or not info["height"]:
+            return "passthrough", info
+        if info["codec"] in STILL_IMAGE_CODECS and not info["duration"]:
+            return "passthrough", info
+        if (info["duration"] and info["duration"] <= SHORT_CLIP_SECONDS
+                and info["width"] * info["height"] <= SHORT_CLIP_MAX_PIXELS):
+            return "clip", info
+        return "video", info
+
+    info = await asyncio.to_thread(probe_image, file_path)
+    if not info:
+        return "passthrough", info
+    if info["format"] == "JPEG" and os.path.getsize(file_path) <= SMALL_IMAGE_BYTES:
+        return "small-image", info
+    return "image", info
+
+async def prepare_media_file(media_obj, file_path):
+    """
+    Convert GIF->MP4 if needed and apply the watermark to a downloaded file,
+    along the route classify_media picks for it.
+    Returns (final_file_path, thumb_path_or_None, info), or (None, None, {}) on
+    failure. info carries the output width/height/duration for videos.
+    Outputs are written next to file_path.
+    """
+    folder = os.path.dirname(file_path)
+    route, probe = await classify_media(media_obj, file_path)
+    metrics.inc("srp_media_routes_total", route=route)
+
+    if route == "passthrough":
+        logger.info(f"[Fast Path] Can't decode {os.path.basename(file_path)}; posting it unchanged.")
+        return file_path, None, {}
+
+    if route in ("video", "clip", "gif"):
+        # GIF->MP4 conversion happens inside the same ffmpeg pass as the watermark
+        logger.info(f"Processing video ({route}): {file_path}")
+        stem = os.path.splitext(os.path.basename(file_path))[0]
+        watermarked_path = os.path.join(folder, f"wm_{stem}.mp4")
+        thumb_path = os.path.join(folder, f"wm_{stem}_thumb.jpg")
+        profile_name = SHORT_CLIP_PROFILE if route == "clip" else None
+        final_video, thumb_path, info = await apply_video_watermark(
+            file_path, watermarked_path, thumb_path, probe, profile_name)
+        if route == "gif" and final_video == file_path:
+            logger.error(f"[GIF->MP4 Error] Conversion failed: {file_path}")
+            return None, None, {}
         if not final_video or not os.path.exists(final_video) or os.path.getsize(final_video) == 0:
             logger.error(f"[Processing Error] Watermarked video missing: {final_video}")
-            return None, None
-        thumb_path = final_video.rsplit(".", 1)[0] + "_thumb.jpg"
-        extract_thumbnail(final_video, thumb_path)
-        return final_video, (thumb_path if os.path.exists(thumb_path) else None)
+            return None, None, {}
+        if route == "gif":
+            remove_files(file_path)
+        return final_video, thumb_path, info
     else:
-        logger.info(f"Processing image: {file_path}")
-        watermarked_image_path = os.path.join(media_folder, f"wm_{os.path.basename(file_path)}")
-        final_image = apply_image_watermark(file_path, watermarked_image_path)
+        logger.info(f"Processing image ({route}): {file_path}")
+        watermarked_image_path = os.path.join(folder, f"wm_{os.path.basename(file_path)}")
+        final_image = await watermark_image(file_path, watermarked_image_path, route == "small-image")
         if not final_image or not os.path.exists(final_image) or os.path.getsize(final_image) == 0:
             logger.error(f"[Processing Error] Watermarked image missing: {final_image}")
-            return None, None
-        return final_image, None
+            return None, None, {}
+        return final_image, None, {}
+
+async def process_media(media_obj):
+    """
+    Download media, convert GIF->MP4 if needed, apply watermark,
+    and return (final_file_path, thumb_path_or_None, info) ready to send.
+    This version validates downloads and returns (None, None, {}) when download fails.
+    """
+    file_path = await download_media_file(media_obj)
+    if not file_path:
+        return None, None, {}
+    return await prepare_media_file(media_obj, file_path)
+
+async def parallel_upload_file(file_path, session_client):
+    """
+    Upload a file like client.upload_file, but keep UPLOAD_PARALLEL_PARTS part
+    requests in flight at once instead of waiting for each part in turn.
+    Only big files (over 10 MB, no MD5 needed) take this path.
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size <= 10 * 1024 * 1024 or UPLOAD_PARALLEL_PARTS < 2:
+        return await api_call(session_client.upload_file, file_path, priority=PRIORITY_BULK)
+
+    part_size = int(utils.get_appropriated_part_size(file_size) * 1024)
+    part_count = (file_size + part_size - 1) // part_size
+    file_id = helpers.generate_random_long()
+    part_indexes = iter(range(part_count))  # shared by the workers
+
+    async def upload_worker():
+        with open(file_path, "rb") as fh:
+            for part_index in part_indexes:
+                fh.seek(part_index * part_size)
+                part = fh.read(part_size)
+                if not await api_call(session_client, SaveBigFilePartRequest(file_id, part_index, part_count, part), priority=PRIORITY_BULK):
+                    raise RuntimeError(f"Failed to upload part {part_index} of {file_path}")
+
+    await asyncio.gather(*(upload_worker() for _ in range(min(UPLOAD_PARALLEL_PARTS, part_count))))
+    return InputFileBig(file_id, part_count, os.path.basename(file_path))
+
+def fits_as_photo(file_path):
+    """True when Telegram accepts the image as a photo (size, dimensions and aspect ratio)."""
+    if os.path.getsize(file_path) > PHOTO_MAX_BYTES:
+        return False
+    try:
+        with Image.open(file_path) as image:
+            width, height = image.size
+    except Exception:
+        return False
+    return (width + height <= PHOTO_MAX_SIDES_SUM
+            and max(width, height) <= PHOTO_MAX_RATIO * max(1, min(width, height)))
+
+async def upload_processed_media(file_path, thumb_path, info, session_client=None):
+    """
+    Upload a processed file (and its thumbnail) without sending it.
+    Returns an InputMedia that session_client (default: the main client) can
+    post later with send_file; uploads belong to the account that made them.
+    Images outside Telegram's photo limits go up as documents.
+    """
+    session_client = session_client or client
+    metrics.inc("srp_bytes_total", os.path.getsize(file_path), direction="out")
+    file_handle = await parallel_upload_file(file_path, session_client)
+    if utils.is_image(file_path) and fits_as_photo(file_path):
+        return InputMediaUploadedPhoto(file=file_handle)
+
+    thumb_handle = await api_call(session_client.upload_file, thumb_path, priority=PRIORITY_BULK) if thumb_path else None
+    mime_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    attributes = [DocumentAttributeFilename(os.path.basename(file_path))]
+    if info and mime_type.startswith("video/"):
+        attributes.append(DocumentAttributeVideo(
+            duration=int(info.get("duration", 0)),
+            w=info.get("width", 0),
+            h=info.get("height", 0),
+            supports_streaming=True
+        ))
+    return InputMediaUploadedDocument(
+        file=file_handle,
+        mime_type=mime_type,
+        attributes=attributes,
+        thumb=thumb_handle,
+        nosound_video=True if mime_type.startswith("video/") else None
+    )
+
+# ======== Media pipeline ========
+pipeline_queues = {}  # id(queue) -> (stage, queue) for every running pipeline
+
+@metrics.collector
+def pipeline_queue_depths():
+    depths = {"download": 0, "process": 0, "upload": 0, "post": 0}
+    for stage, queue in pipeline_queues.values():
+        depths[stage] += queue.qsize()
+    return [("srp_queue_depth", "gauge", {"stage": stage}, depth) for stage, depth in depths.items()]
+
+class PipelineItem:
+    """One media object (given as itself or as the message carrying it) travelling through run_media_pipeline."""
+
+    def __init__(self, index, source):
+        self.index = index
+        self.message = source if hasattr(source, "media") else None  # a Message; MessageMedia has no .media
+        media = self.message.media if self.message else source
+        self.media = media
+        self.cache_keys = media_cache_keys(media)
+        self.cache_entry = None
+        self.size = media_source_size(media)
+        self.file_path = None
+        self.processed_file = None
+        self.thumb_file = None
+        self.info = {}
+        self.stream_info = None  # set when the item is streamed into ffmpeg
+        self.input_media = None  # set once the item is ready to post
+        self.sent_msg = None     # channel message when a run before a restart already posted it
+        self.account = accounts.primary  # uploads and posts the item
+        self.reserved = 0        # scratch bytes held until the item's files are deleted
+        self.ready = None        # future: True when postable, False when it failed
+
+    @property
+    def postable(self):
+        return self.input_media is not None or self.sent_msg is not None
+
+    @property
+    def album_ok(self):
+        """Photos and videos can share an album; other documents are posted alone."""
+        if self.cache_entry:
+            return self.cache_entry.get("album", False)
+        if isinstance(self.input_media, InputMediaUploadedPhoto):
+            return True
+        return isinstance(self.input_media, InputMediaUploadedDocument) and self.input_media.mime_type.startswith("video/")
+
+async def iterate_media(media_items):
+    for media_obj in media_items:
+        yield media_obj
+
+async def run_media_pipeline(media_source, job_id=None, resume=None):
+    """
+    Push media through download -> watermark -> upload stages that run concurrently.
+    media_source is a list or an async iterator of media or of the messages
+    carrying them (which lets workers download them); items start downloading as soon
+    as the iterator yields them. Each stage has its own workers fed by a bounded
+    queue, so item N+1 downloads while item N encodes and item N-1 uploads. Items
+    found in media_cache skip straight to posting. Uploaded items are posted in
+    albums of up to UPLOAD_GROUP_SIZE, strictly in arrival order and under
+    channel_post_lock so concurrent sessions don't interleave.
+    Each item's progress is journaled under job_id; resume maps media keys to
+    the journal rows of a run interrupted by a restart, whose intermediate
+    files and posted messages are reused. Files live in a per-run workspace,
+    and each item's files are deleted once it is posted or fails (its
+    download already once it is uploaded).
+    Transfers are spread over the account pool: each album-sized block of items
+    is uploaded and posted by one account.
+    Returns the sent messages, skipping failures.
+    """
+    loop = asyncio.get_running_loop()
+    workspace = scratch.workspace(job_id)
+    if isinstance(media_source, (list, tuple)):
+        media_source = iterate_media(media_source)
+    ready_queue = asyncio.Queue()  # PipelineItems in arrival order, then None
+    download_queue = asyncio.Queue()
+    process_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    upload_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    for stage, queue in (("download", download_queue), ("process", process_queue),
+                         ("upload", upload_queue), ("post", ready_queue)):
+        pipeline_queues[id(queue)] = (stage, queue)
+
+    items = []
+
+    async def feed_items():
+        try:
+            index = 0
+            async for media_obj in media_source:
+                item = PipelineItem(index, media_obj)
+                item.ready = loop.create_future()
+                items.append(item)
+                index += 1
+                ready_queue.put_nowait(item)
+                download_queue.put_nowait(item)
+        finally:
+            ready_queue.put_nowait(None)
+            for _ in range(DOWNLOAD_WORKERS):
+                download_queue.put_nowait(None)
+
+    def use_cache_entry(item, entry):
+        item.cache_entry = entry
+        item.account = accounts.named(entry.get("account"))  # stored references are per account
+        item.info = entry.get("info", {})
+        item.input_media = media_cache.input_media(entry)
+        logger.info(f"[Cache Hit] Item {item.index + 1}: re-sending channel message {entry['msg_id']}")
+
+    def file_on_disk(path):
+        return path if path and os.path.exists(path) else None
+
+    async def resume_item(item):
+        """Restore item from its journal row; True when it doesn't need downloading."""
+        row = resume.get(item.cache_keys[0]) if resume and item.cache_keys else None
+        if not row:
+            return False
+        if row["sent_msg_id"]:
+            item.sent_msg = await api_call(client.get_messages, target_channel_id, ids=row["sent_msg_id"])
+            if item.sent_msg:
+                logger.info(f"[Resume] Item {item.index + 1} already posted as message {item.sent_msg.id}")
+                journal.set_item_stage(job_id, item.index, "uploaded", sent_msg_id=item.sent_msg.id)
+                return True
+        if file_on_disk(row["processed_file"]):
+            item.processed_file = row["processed_file"]
+            item.thumb_file = file_on_disk(row["thumb_file"])
+            item.info = json.loads(row["info"] or "{}")
+            logger.info(f"[Resume] Item {item.index + 1}: reusing watermarked {item.processed_file}")
+            journal.set_item_stage(job_id, item.index, "watermarked", processed_file=item.processed_file,
+                                   thumb_file=item.thumb_file, info=item.info)
+            return True
+        if file_on_disk(row["file_path"]):
+            item.file_path = row["file_path"]
+            logger.info(f"[Resume] Item {item.index + 1}: reusing download {item.file_path}")
+            journal.set_item_stage(job_id, item.index, "downloaded", file_path=item.file_path)
+            return True
+        return False
+
+    async def download_stage(item):
+        resumed = await resume_item(item)
+        if item.sent_msg:
+            return True
+        if not resumed:
+            entry = media_cache.get(item.cache_keys, count_miss=False)
+            if entry:
+                use_cache_entry(item, entry)
+                return True
+        # Backpressure: wait for room in the scratch quota before adding files
+        item.reserved = scratch.estimate(item.size)
+        await scratch.reserve(item.reserved)
+        if resumed:
+            return True
+        folder = workspace.folder_for(item.size)
+        item.stream_info = stream_media_info(item.media)
+        if item.stream_info:
+            # Downloading happens inside the process stage, piped into ffmpeg
+            return True
+        item.file_path = await download_sharded(item.media, folder, item.size, item.message)
+        if not item.file_path:
+            return False
+        if not item.size:
+            item.size = os.path.getsize(item.file_path)
+        journal.set_item_stage(job_id, item.index, "downloaded", file_path=item.file_path)
+        return True
+
+    async def watermarked(item):
+        if item.info and item.processed_file != item.file_path:
+            # Videos are posted byte for byte, so a copy of this output coming back
+            # later (a repost of our channel) is recognised by its hash and not encoded again
+            item.cache_keys.append("wm:" + await asyncio.to_thread(file_sha256, item.processed_file))
+        journal.set_item_stage(job_id, item.index, "watermarked", processed_file=item.processed_file,
+                               thumb_file=item.thumb_file, info=item.info)
+        return True
+
+    async def process_stage(item):
+        if item.processed_file:  # resumed after a restart
+            return True
+        if item.stream_info:
+            digest = hashlib.sha256()
+            item.processed_file, item.thumb_file, item.info, item.file_path = await stream_media_file(
+                item.media, item.stream_info, digest, workspace.folder_for(item.size))
+            if item.processed_file:
+                item.cache_keys.append("sha:" + digest.hexdigest())
+                return await watermarked(item)
+            if not item.file_path:
+                return False
+        # Same bytes may arrive under a different document id, or be our own watermarked output
+        digest = await asyncio.to_thread(file_sha256, item.file_path)
+        sha_key = "sha:" + digest
+        item.cache_keys.append(sha_key)
+        entry = media_cache.get([sha_key, "wm:" + digest])
+        if entry:
+            if "wm:" + digest in entry["keys"]:
+                metrics.inc("srp_media_routes_total", route="already-watermarked")
+                logger.info(f"[Fast Path] Item {item.index + 1} already carries our watermark.")
+            media_cache.add_keys(entry, item.cache_keys)
+            use_cache_entry(item, entry)
+            return True
+        item.processed_file, item.thumb_file, item.info = await prepare_media_file(item.media, item.file_path)
+        return bool(item.processed_file) and await watermarked(item)
+
+    upload_accounts = {}  # album-sized block of item indexes -> Account
+
+    def upload_account(item):
+        # Items that may share an album upload on one account, since that account has to post them
+        block = item.index // UPLOAD_GROUP_SIZE
+        if block not in upload_accounts or not upload_accounts[block].available:
+            upload_accounts[block] = accounts.pick()
+        return upload_accounts[block]
+
+    async def upload_stage(item):
+        item.account = upload_account(item)
+        size = os.path.getsize(item.processed_file)
+        try:
+            with accounts.lease(item.account, size):
+                item.input_media = await upload_processed_media(item.processed_file, item.thumb_file, item.info,
+                                                                item.account.client)
+            return True
+        except Exception as e:
+            if item.account.primary:
+                raise
+            logger.warning(f"[Accounts] Upload of item {item.index + 1} on {item.account.name} failed ({e}); retrying.")
+            accounts.take_out(item.account)
+        # Later items of the block follow; the sequencer starts a new album when the account changes
+        item.account = upload_accounts[item.index // UPLOAD_GROUP_SIZE] = accounts.pick()
+        with accounts.lease(item.account, size):
+            item.input_media = await upload_processed_media(item.processed_file, item.thumb_file, item.info,
+                                                            item.account.client)
+        return True
+
+    async def release_item(item, keep_output=False):
+        """
+        The item is uploaded, cached or failed: its local files are no longer
+        needed. keep_output keeps the watermarked file and thumbnail until the
+        post is journaled, so a crash before then resumes by uploading them again.
+        They are no longer counted against the quota: an upload waiting on
+        another session's channel_post_lock must not hold up that session's downloads.
+        """
+        if not keep_output:
+            remove_files(item.processed_file, item.thumb_file)
+        if not keep_output or item.file_path != item.processed_file:  # passthrough posts its download
+            remove_files(item.file_path)
+        await scratch.release(item.reserved)
+        item.reserved = 0
+
+    async def stage_worker(name, inbox, handler, outbox):
+        while True:
+            item = await inbox.get()
+            if item is None:
+                return
+            try:
+                with metrics.span(name, job=job_id):
+                    ok = await handler(item)
+                if not ok:
+                    metrics.inc("srp_failures_total", span=name)
+            except Exception as e:
+                logger.error(f"[Pipeline] {name} failed for item {item.index + 1}: {e}")
+                ok = False
+            if ok and outbox is None:
+                await release_item(item, keep_output=True)
+                item.ready.set_result(ok)
+            elif not ok or item.postable:
+                await release_item(item)
+                item.ready.set_result(ok)
+            else:
+                await outbox.put(item)
+
+    async def run_stage(name, workers, inbox, handler, outbox, next_workers):
+        await asyncio.gather(*(stage_worker(name, inbox, handler, outbox) for _ in range(workers)))
+        # Tell every worker of the next stage that no more items are coming
+        for _ in range(next_workers):
+            await outbox.put(None)
+
+    async def send_item(item):
+        session_client = item.account.client
+        try:
+            return await api_call(session_client.send_file, target_channel_id, file=item.input_media,
+                                  supports_streaming=True, priority=PRIORITY_BULK)
+        except Exception as e:
+            if not item.cache_entry:
+                raise
+            # The stored file reference may have expired; refresh it from the channel copy
+            logger.warning(f"[Cache] Stored reference failed ({e}); refreshing from channel message.")
+            old_msg = await api_call(session_client.get_messages, target_channel_id, ids=item.cache_entry["msg_id"])
+            if not old_msg or not old_msg.media:
+                media_cache.discard(item.cache_keys)
+                raise
+            return await api_call(session_client.send_file, target_channel_id, file=old_msg.media,
+                                  supports_streaming=True, priority=PRIORITY_BULK)
+
+    async def send_group(group):
+        """Post group (all on one account) as one album; returns one message (or None) per item."""
+        if len(group) > 1:
+            try:
+                return await api_call(group[0].account.client.send_file, target_channel_id,
+                                      [item.input_media for item in group],
+                                      supports_streaming=True, priority=PRIORITY_BULK)
+            except Exception as e:
+                logger.warning(f"[Album] Sending {len(group)} files as an album failed ({e}); sending one by one.")
+        results = []
+        for item in group:
+            try:
+                results.append(await send_item(item))
+            except Exception as e:
+                logger.error(f"[Send Error] File {item.index + 1}: {e}")
+                results.append(None)
+        return results
+
+    stages = asyncio.gather(
+        feed_items(),
+        run_stage("download", DOWNLOAD_WORKERS, download_queue, download_stage, process_queue, PROCESS_WORKERS),
+        run_stage("process", PROCESS_WORKERS, process_queue, process_stage, upload_queue, UPLOAD_WORKERS),
+        *(stage_worker("upload", upload_queue, upload_stage, None) for _ in range(UPLOAD_WORKERS)),
+    )
+
+    sent_messages = []
+    group = []
+    holds_channel = False
+
+    async def flush_group():
+        nonlocal holds_channel
+        if not group:
+            return
+        if not holds_channel:
+            # Other sessions may be posting too; keep this batch's messages contiguous
+            await channel_post_lock.acquire()
+            holds_channel = True
+        with metrics.span("post", job=job_id):
+            results = await send_group(group)
+        for item, sent_msg in zip(group, results):
+            if sent_msg is None:
+                metrics.inc("srp_failures_total", span="post")
+                continue
+            metrics.inc("srp_items_posted_total")
+            sent_messages.append(sent_msg)
+            journal.set_item_stage(job_id, item.index, "uploaded", sent_msg_id=sent_msg.id)
+            if not item.cache_entry:
+                media_cache.put(item.cache_keys, sent_msg, item.info, item.size, item.account.name)
+        for item in group:
+            remove_files(item.processed_file, item.thumb_file)
+        group.clear()
+
+    with workspace:
+        try:
+            while True:
+                item = await ready_queue.get()
+                if item is None:
+                    break
+                if not await item.ready:
+                    logger.error(f"Skipping file {item.index + 1} due to processing error.")
+                    continue
+                if item.sent_msg:
+                    await flush_group()
+                    sent_messages.append(item.sent_msg)
+                    continue
+                if not item.album_ok or (group and group[0].account is not item.account):
+                    await flush_group()
+                group.append(item)
+                if not item.album_ok or len(group) >= UPLOAD_GROUP_SIZE:
+                    await flush_group()
+            await flush_group()
+            await stages
+        finally:
+            if holds_channel:
+                channel_post_lock.release()
+            stages.cancel()
+            # Let cancelled workers stop writing before their workspace is deleted
+            await asyncio.wait([stages])
+            for item in items:
+                await scratch.release(item.reserved)
+            for queue in (download_queue, process_queue, upload_queue, ready_queue):
+                pipeline_queues.pop(id(queue), None)
+            media_cache.flush()
+
+    logger.info(f"[Cache] {media_cache.stats()}")
+    logger.info(f"[Scheduler] {api_scheduler.stats()}")
+    return sent_messages
+
+# ======== Fetch sessions ========
+class FetchSession:
+    """
+    One /start request sent to a source bot on behalf of a channel post.
+    Sessions are keyed by (bot sender id, request id); sessions for different
+    bots collect and process in parallel, same-bot sessions take turns.
+    Collected media is queued so the pipeline can start on it right away.
+    """
+
+    def __init__(self, request_id, bot_username, file_id, original_msg, original_caption):
+        self.request_id = request_id
+        self.bot_username = bot_username
+        self.file_id = file_id
+        self.original_msg = original_msg
+        self.original_caption = original_caption
+        self.bot_id = None
+        self.media = []
+        self.media_queue = asyncio.Queue()
+        self.activity = asyncio.Event()
+        self.last_media_at = None
+        self.source_done = False
+        self.first_msg_link = None
+        self.last_msg_link = None
+        self.job_id = None       # journal row
+        self.resume = {}         # media key -> journal row of an interrupted run
+
+    @property
+    def key(self):
+        return (self.bot_id, self.request_id)
+
+    def add_media(self, message, record_gap=True):
+        """Queue a media message; record_gap=False for messages re-read on resume, not live arrivals."""
+        if record_gap:
+            now = asyncio.get_running_loop().time()
+            if self.last_media_at is not None:
+                arrival_gaps.append(now - self.last_media_at)
+            self.last_media_at = now
+        media = message.media
+        keys = media_cache_keys(media)
+        journal.add_item(self.job_id, len(self.media), keys[0] if keys else None, self.bot_id, message.id)
+        self.media.append(media)
+        self.media_queue.put_nowait(message)
+        self.activity.set()
+
+    def mark_source_done(self):
+        self.source_done = True
+        self.activity.set()
+
+    def close(self):
+        """No more media will arrive; ends iter_media."""
+        self.media_queue.put_nowait(None)
+
+    async def iter_media(self):
+        """Yield the collected media messages as they arrive."""
+        while True:
+            message = await self.media_queue.get()
+            if message is None:
+                return
+            yield message
+
+    def __repr__(self):
+        return f"<session {self.request_id} {self.bot_username}>"
+
+def current_idle_gap():
+    """
+    Idle gap after which a session is considered complete: 1.5x the 95th
+    percentile of observed inter-arrival gaps, clamped to the configured range.
+    """
+    if not SESSION_ADAPTIVE_IDLE_GAP or len(arrival_gaps) < 20:
+        return SESSION_IDLE_GAP
+    gaps = sorted(arrival_gaps)
+    p95 = gaps[min(len(gaps) - 1, int(len(gaps) * 0.95))]
+    return min(SESSION_IDLE_GAP_MAX, max(SESSION_IDLE_GAP_MIN, p95 * 1.5))
 
 # ======== Bot event handlers (high-level logic) ========
 @client.on(events.NewMessage(chats=target_channel_id))
 async def detect_batch_or_single_message(event):
-    global active_session, original_batch_msg, original_caption
-
     msg = event.message
 
     if msg.grouped_id:
-        logger.info("Batch detected, processing group of messages.")
-        await asyncio.sleep(1.5)
-        messages = await client.get_messages(msg.chat_id, limit=100)
-        batch_messages = [m for m in messages if m.grouped_id == msg.grouped_id]
-
-        for media_msg in batch_messages:
-            text = (media_msg.text or "") + (media_msg.message or "")
-            match = link_regex.search(text)
-            if match:
-                bot_username = '@' + match.group(1)
-                file_id = match.group(2)
-                original_batch_msg = media_msg
-                original_caption = media_msg.text or media_msg.message or ''
-                await start_fetch_session(bot_username, file_id)
-                break
+        buffer_album_part(msg)
 
     elif msg.media and (msg.text or msg.message):
         text = msg.text or msg.message
@@ -372,224 +2409,534 @@ async def detect_batch_or_single_message(event):
             bot_username = '@' + match.group(1)
             file_id = match.group(2)
             logger.info("Single media message detected.")
-            original_batch_msg = msg
-            original_caption = text
-            await start_fetch_session(bot_username, file_id)
+            await start_fetch_session(bot_username, file_id, msg, text)
+
+def buffer_album_part(msg):
+    """Add an album part to its grouped_id buffer and (re)arm the debounce timer."""
+    grouped_id = msg.grouped_id
+    if grouped_id in flushed_albums:
+        logger.warning(f"Late album part {msg.id} for already handled group {grouped_id}; ignoring.")
+        return
+
+    album_parts.setdefault(grouped_id, []).append(msg)
+    timer = album_timers.pop(grouped_id, None)
+    if timer:
+        timer.cancel()
+    album_timers[grouped_id] = asyncio.get_running_loop().call_later(
+        ALBUM_DEBOUNCE, lambda: asyncio.create_task(flush_album(grouped_id)))
+
+async def flush_album(grouped_id):
+    """Handle a buffered album exactly once, using the part whose caption has the link."""
+    album_timers.pop(grouped_id, None)
+    batch_messages = sorted(album_parts.pop(grouped_id, []), key=lambda m: m.id)
+    flushed_albums[grouped_id] = True
+    while len(flushed_albums) > FLUSHED_ALBUMS_KEPT:
+        flushed_albums.popitem(last=False)
+
+    logger.info(f"Batch detected, processing group of {len(batch_messages)} messages.")
+    for media_msg in batch_messages:
+        text = media_msg.text or media_msg.message or ""
+        match = link_regex.search(text)
+        if match:
+            bot_username = '@' + match.group(1)
+            file_id = match.group(2)
+            caption = media_msg.text or media_msg.message or ''
+            try:
+                await start_fetch_session(bot_username, file_id, media_msg, caption)
+            except Exception as e:
+                logger.error(f"[Album Error] group {grouped_id}: {e}")
+            break
 
-async def start_fetch_session(bot_username, file_id):
-    global active_session, media_from_bot, bot_sender_id
+async def start_fetch_session(bot_username, file_id, original_msg, original_caption):
+    session = FetchSession(next(request_ids), bot_username, file_id, original_msg, original_caption)
+    bot_entity = await resolve_entity(bot_username)
+    session.bot_id = bot_entity.id
+    session.job_id = journal.start_job(session)
+    sessions[session.key] = session
+    asyncio.create_task(run_fetch_session(session, bot_entity))
 
-    if active_session:
-        logger.warning("Session already active. Ignoring new request.")
+async def run_fetch_session(session, bot_entity):
+    """
+    Collect the source bot's media for session while the pipeline already
+    processes and posts it, then generate the link.
+    Only one session per bot collects at a time, because the bot's replies
+    can't be told apart; a new request for a busy bot waits its turn.
+    """
+    lock = bot_locks.setdefault(session.bot_id, asyncio.Lock())
+    if lock.locked():
+        logger.info(f"{session.bot_username} busy; queued request {session.request_id}.")
+    pipeline = None
+    try:
+        async with lock:
+            active_by_bot[session.bot_id] = session
+            pipeline = asyncio.create_task(run_media_pipeline(session.iter_media(), session.job_id, session.resume))
+            try:
+                await api_call(client.send_message, bot_entity, f'/start {session.file_id}')
+                logger.info(f"Sent /start {session.file_id} to {session.bot_username} (request {session.request_id})")
+                with metrics.span("collect", job=session.job_id):
+                    await timeout_monitor(session)
+            finally:
+                active_by_bot.pop(session.bot_id, None)
+                session.close()
+        journal.set_state(session.job_id, "posting")
+        # The bot is free for the next request while this one finishes processing
+        sent_messages = await pipeline
+        journal.set_state(session.job_id, "posted")
+        await process_session(session, sent_messages)
+    except Exception as e:
+        logger.error(f"[Session Error] {session}: {e}")
+        journal.set_state(session.job_id, "failed")
+        if pipeline and not pipeline.done():
+            pipeline.cancel()
+    finally:
+        sessions.pop(session.key, None)
+
+async def resume_jobs():
+    """Continue the jobs a previous run left unfinished, each from its last completed stage."""
+    jobs = journal.unfinished_jobs()
+    # Leftovers of finished or failed runs are garbage; unfinished jobs keep theirs
+    scratch.sweep({f"job_{job['id']}" for job in jobs})
+    for job in jobs:
+        try:
+            await resume_job(job)
+        except Exception as e:
+            logger.error(f"[Resume] Job {job['id']} failed: {e}")
+            journal.set_state(job["id"], "failed")
+
+async def resume_job(job):
+    original_msg = await api_call(client.get_messages, target_channel_id, ids=job["post_msg_id"])
+    if not original_msg:
+        logger.warning(f"[Resume] Post {job['post_msg_id']} of job {job['id']} is gone; dropping the job.")
+        journal.set_state(job["id"], "failed")
+        return
+    session = FetchSession(next(request_ids), job["bot_username"], job["file_id"], original_msg, job["caption"])
+    session.job_id = job["id"]
+    logger.info(f"[Resume] Job {job['id']} for post {job['post_msg_id']} was {job['state']}; resuming as request {session.request_id}.")
+    if job["state"] == "linked":
+        await clean_caption_and_edit(session, job["link"])
         return
 
-    active_session = True
-    media_from_bot.clear()
+    rows = journal.items(job["id"])
+    session.resume = {row["media_key"]: row for row in rows if row["media_key"]}
+    journal.clear_items(job["id"])  # re-recorded as the items go through the pipeline again
+    bot_entity = await resolve_entity(job["bot_username"])
+    session.bot_id = bot_entity.id
+    if job["state"] == "collecting":
+        # The source bot may not have sent everything yet, so ask again; finished items are reused
+        sessions[session.key] = session
+        asyncio.create_task(run_fetch_session(session, bot_entity))
+        return
 
-    bot_entity = await client.get_entity(bot_username)
-    bot_sender_id = bot_entity.id
-    await client.send_message(bot_entity, f'/start {file_id}')
-    logger.info(f"Sent /start {file_id} to {bot_username}")
+    # Collection had finished: rebuild the media list from the bot chat
+    messages = await api_call(client.get_messages, bot_entity, ids=[row["source_msg_id"] for row in rows])
+    for message in messages:
+        if message and message.media:
+            session.add_media(message, record_gap=False)  # back-to-back reads would skew the idle gap
+    session.close()
+    asyncio.create_task(finish_resumed_session(session))
 
-    asyncio.create_task(timeout_monitor())
+async def finish_resumed_session(session):
+    try:
+        sent_messages = await run_media_pipeline(session.iter_media(), session.job_id, session.resume)
+        journal.set_state(session.job_id, "posted")
+        await process_session(session, sent_messages)
+    except Exception as e:
+        logger.error(f"[Session Error] {session}: {e}")
+        journal.set_state(session.job_id, "failed")
 
 @client.on(events.NewMessage)
 async def collect_bot_media(event):
-    global media_from_bot
-
-    if not active_session:
+    if event.out:
         return
 
-    if event.media and not event.out and event.sender_id == bot_sender_id:
-        media_from_bot.append(event.message.media)
-        logger.info(f"Collected media ID: {event.message.id}")
-
-async def timeout_monitor():
-    global active_session, media_from_bot
-
-    wait_time = 0
-    while active_session:
-        await asyncio.sleep(2)
-        wait_time += 2
+    session = active_by_bot.get(event.sender_id)
+    if not session:
+        return
 
-        if wait_time > 30:
-            active_session = False
-            logger.info("Session timeout. Proceeding to next step.")
+    if event.media:
+        session.add_media(event.message)
+        logger.info(f"Collected media ID: {event.message.id} (request {session.request_id})")
+    elif source_done_regex and source_done_regex.search(event.raw_text or ""):
+        logger.info(f"{session.bot_username} reported all files sent (request {session.request_id}).")
+        session.mark_source_done()
 
-            if len(media_from_bot) > 1:
-                await handle_batch()
-            elif len(media_from_bot) == 1:
-                await handle_single_file()
-            else:
-                logger.warning("No media received.")
+async def timeout_monitor(session):
+    """
+    Wait until the session is complete: the source bot went quiet for the idle
+    gap after its last media, said it was done, sent nothing at all within
+    SESSION_FIRST_MEDIA_TIMEOUT, or SESSION_MAX_DURATION passed.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    hard_deadline = started + SESSION_MAX_DURATION
+    while True:
+        if session.source_done:
+            reason = "source bot finished"
             break
+        idle_gap = current_idle_gap()
+        if session.last_media_at is None:
+            deadline = started + SESSION_FIRST_MEDIA_TIMEOUT
+        else:
+            deadline = session.last_media_at + idle_gap
+        now = loop.time()
+        if now >= hard_deadline:
+            reason = "hard cap reached"
+            break
+        if now >= deadline:
+            reason = "no media" if session.last_media_at is None else f"idle for {idle_gap:.1f}s"
+            break
+        session.activity.clear()
+        try:
+            await asyncio.wait_for(session.activity.wait(), min(deadline, hard_deadline) - now)
+        except asyncio.TimeoutError:
+            pass
 
-async def handle_batch():
-    global first_msg_link, last_msg_link, media_from_bot
-
-    channel_id_clean = str(target_channel_id).replace('-100', '')
-    first_msg_link = None
-    last_msg_link = None
+    logger.info(
+        f"Session complete for request {session.request_id} ({reason}) after "
+        f"{loop.time() - started:.1f}s with {len(session.media)} media; idle gap now {current_idle_gap():.1f}s."
+    )
 
-    for idx, media_obj in enumerate(media_from_bot):
-        processed_file, thumb_file = await process_media(media_obj)
-        if not processed_file:
-            logger.error("Skipping file due to processing error.")
-            continue
+async def process_session(session, sent_messages):
+    if len(sent_messages) > 1:
+        await handle_batch(session, sent_messages)
+    elif len(sent_messages) == 1:
+        await handle_single_file(session, sent_messages[0])
+    elif session.media:
+        logger.error(f"Processing failed for all media of request {session.request_id}.")
+        journal.set_state(session.job_id, "failed")
+    else:
+        logger.warning(f"No media received for request {session.request_id}.")
+        journal.set_state(session.job_id, "failed")
 
-        # === Extract video info for attributes ===
-        info = extract_video_info(processed_file)
-        attributes = []
-        if info:
-            attributes.append(DocumentAttributeVideo(
-                duration=int(info.get("duration", 0)),
-                w=info.get("width", 0),
-                h=info.get("height", 0),
-                supports_streaming=True
-            ))
-
-        sent_msg = await client.send_file(
-            target_channel_id,
-            file=processed_file,
-            thumb=thumb_file,
-            attributes=attributes,
-            supports_streaming=True
-        )
+async def handle_batch(session, sent_messages):
+    channel_id_clean = str(target_channel_id).replace('-100', '')
 
+    for sent_msg in sent_messages:
         msg_link = f"https://t.me/c/{channel_id_clean}/{sent_msg.id}"
-
-        if idx == 0:
-            first_msg_link = msg_link
-        last_msg_link = msg_link
-
+        if session.first_msg_link is None:
+            session.first_msg_link = msg_link
+        session.last_msg_link = msg_link
         logger.info(f"Uploaded batch file to channel: {msg_link}")
 
-        for f in [processed_file, thumb_file]:
-            if f and os.path.exists(f):
-                try:
-                    os.remove(f)
-                except:
-                    pass
-
-    media_from_bot.clear()
-    await handle_batch_creator()
-
-async def handle_single_file():
-    global media_from_bot
-
-    processed_file, thumb_file = await process_media(media_from_bot[0])
-    if not processed_file:
-        logger.error("Processing failed for single file; aborting upload.")
-        media_from_bot.clear()
-        return
-
-        # === Extract video info for attributes ===
-    info = extract_video_info(processed_file)
-    attributes = []
-    if info:
-        attributes.append(DocumentAttributeVideo(
-            duration=int(info.get("duration", 0)),
-            w=info.get("width", 0),
-            h=info.get("height", 0),
-            supports_streaming=True
-        ))
-
-    sent_msg = await client.send_file(
-        target_channel_id,
-        file=processed_file,
-        thumb=thumb_file,
-        attributes=attributes,
-        supports_streaming=True
-    )
+    await handle_batch_creator(session)
 
-    media_from_bot.clear()
+async def handle_single_file(session, sent_msg):
     logger.info("Uploaded single file to channel.")
+    await handle_single_file_link(session, sent_msg)
 
-    for f in [processed_file, thumb_file]:
-        if f and os.path.exists(f):
-            try:
-                os.remove(f)
-            except:
-                pass
-
-    await handle_single_file_link(sent_msg)
-
-async def handle_batch_creator():
-    batch_bot = await client.get_entity(batch_bot_username)
+async def handle_batch_creator(session):
+    with metrics.span("link", job=session.job_id, kind="batch"):
+        batch_link = await link_service.batch_link(session.first_msg_link, session.last_msg_link)
 
-    await client.send_message(batch_bot, '/batch')
-    logger.info("Sent /batch to batch bot.")
-
-    await wait_for_reply(batch_bot, "first message")
-    await client.send_message(batch_bot, first_msg_link)
-    logger.info(f"Sent first message link: {first_msg_link}")
-
-    await wait_for_reply(batch_bot, "last message")
-    await client.send_message(batch_bot, last_msg_link)
-    logger.info(f"Sent last message link: {last_msg_link}")
-
-    batch_link = await wait_for_link(batch_bot)
     if batch_link:
         logger.info(f"Batch link generated: {batch_link}")
-        await clean_caption_and_edit(batch_link)
+        journal.set_state(session.job_id, "linked", batch_link)
+        await clean_caption_and_edit(session, batch_link)
     else:
         logger.error("Failed to generate batch link.")
+        journal.set_state(session.job_id, "failed")
 
-async def handle_single_file_link(sent_msg):
-    batch_bot = await client.get_entity(batch_bot_username)
-    await client.send_message(batch_bot, '/genlink')
-    logger.info("Sent /genlink to batch bot.")
+async def handle_single_file_link(session, sent_msg):
+    with metrics.span("link", job=session.job_id, kind="single"):
+        single_link = await link_service.single_link(sent_msg.id)
 
-    await wait_for_reply(batch_bot, "send")
-    await client.forward_messages(batch_bot, sent_msg)
-    logger.info("Forwarded single file to bot.")
-
-    single_link = await wait_for_link(batch_bot)
     if single_link:
         logger.info(f"Single file link generated: {single_link}")
-        await clean_caption_and_edit(single_link)
+        journal.set_state(session.job_id, "linked", single_link)
+        await clean_caption_and_edit(session, single_link)
     else:
         logger.error("Failed to get single file link.")
+        journal.set_state(session.job_id, "failed")
 
-async def clean_caption_and_edit(new_link):
-    global original_batch_msg
-
+async def clean_caption_and_edit(session, new_link):
     # Build the new formatted caption
     updated_caption = (
         "<b>HERE IS YOUR LINK 🔗</b>\n\n"
         f"<blockquote><b><a href=\"{new_link}\">{new_link}</a></b></blockquote>"
     )
 
-    # Edit the message with HTML parsing
-    await client.edit_message(
-        target_channel_id,
-        original_batch_msg.id,
-        updated_caption,
-        parse_mode="html"
-    )
+    # Edit the message with HTML parsing, batched with other edits of the channel
+    with metrics.span("caption_edit", job=session.job_id):
+        await caption_editor.edit(target_channel_id, session.original_msg.id, updated_caption)
 
+    journal.set_state(session.job_id, "done")
     logger.info("Edited original message caption with formatted new link (HTML with blockquote).")
 
-async def wait_for_reply(bot_entity, expected_text):
-    for _ in range(30):
-        msgs = await client.get_messages(bot_entity, limit=1)
-        if msgs and expected_text in (msgs[0].message or "").lower():
-            return
-        await asyncio.sleep(2)
+# ======== Link service ========
+class LinkRequest:
+    """One link to generate: the messages of its batch-bot dialogue, each with the reply it expects."""
+
+    def __init__(self, key, steps):
+        self.key = key
+        self.steps = steps      # [(send coroutine factory, reply predicate), ...]; the last reply has the link
+        self.future = asyncio.get_running_loop().create_future()
+
+class LinkService:
+    """
+    The single, ordered conversation with the batch bot. Requests queue in
+    arrival order and run back to back; while up to LINK_PIPELINE_DEPTH of
+    them wait for their link, the next one's dialogue already starts. A reply
+    is matched to the request that asked for it: it must come after (and, if
+    the bot replies to a message, reply to) that request's last message, and
+    replies of one kind are handed out in request order. Asking again for a
+    link that is already queued shares its result.
+    """
 
-async def wait_for_link(bot_entity):
-    for _ in range(30):
-        msgs = await client.get_messages(bot_entity, limit=1)
-        if not msgs:
-            await asyncio.sleep(2)
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.pending = {}       # key -> LinkRequest queued or in flight
+        self.runner = None
+        self.last_sent_id = 0   # newest message we sent the batch bot
+        self.link_waits = []    # (request, waiter) still waiting for a link, oldest first
+        self.generated = 0
+        self.failed = 0
+
+    def batch_link(self, first_msg_link, last_msg_link):
+        return self.request(("batch", first_msg_link, last_msg_link), [
+            (lambda bot: api_call(client.send_message, bot, '/batch', priority=PRIORITY_HIGH),
+             reply_contains("first message")),
+            (lambda bot: api_call(client.send_message, bot, first_msg_link, priority=PRIORITY_HIGH),
+             reply_contains("last message")),
+            (lambda bot: api_call(client.send_message, bot, last_msg_link, priority=PRIORITY_HIGH),
+             reply_has_link),
+        ])
+
+    def single_link(self, msg_id):
+        return self.request(("single", msg_id), [
+            (lambda bot: api_call(client.send_message, bot, '/genlink', priority=PRIORITY_HIGH),
+             reply_contains("send")),
+            # By id: a worker's copy of the message carries that worker's channel access hash
+            (lambda bot: api_call(client.forward_messages, bot, msg_id, from_peer=target_channel_id,
+                                  priority=PRIORITY_HIGH),
+             reply_has_link),
+        ])
+
+    async def request(self, key, steps):
+        """Queue a dialogue (or join the identical one already queued); returns the link or None."""
+        request = self.pending.get(key)
+        if request is None:
+            request = self.pending[key] = LinkRequest(key, steps)
+            self.queue.put_nowait(request)
+            if self.runner is None or self.runner.done():
+                self.runner = asyncio.ensure_future(self.run())
+        return await asyncio.shield(request.future)
+
+    async def run(self):
+        in_flight = asyncio.Semaphore(LINK_PIPELINE_DEPTH)
+        while True:
+            request = await self.queue.get()
+            await in_flight.acquire()
+            try:
+                waiter = await self.converse(request)
+            except Exception as e:
+                logger.error(f"[Link] Dialogue for {request.key} failed: {e}")
+                waiter = None
+            if waiter is None:
+                self.finish(request, None)
+                in_flight.release()
+                continue
+            self.link_waits.append((request, waiter))
+            asyncio.ensure_future(self.await_link(request, waiter, in_flight))
+
+    def expect_reply(self, bot_id, predicate, asked):
+        """Wait for predicate's reply to the message whose id asked["id"] will hold once sent."""
+        previous_id = self.last_sent_id
+
+        def matches(msg):
+            after_id = asked.get("id") or previous_id
+            reply_to = getattr(msg, "reply_to_msg_id", None)
+            if msg.id <= after_id or (reply_to and asked.get("id") and reply_to != asked["id"]):
+                return False
+            return predicate(msg)
+        return expect_message(bot_id, matches)
+
+    async def converse(self, request):
+        """Send request's messages up to the last one; returns the waiter for its link, or None."""
+        batch_bot = await resolve_entity(batch_bot_username, PRIORITY_HIGH)
+        for index, (send, predicate) in enumerate(request.steps):
+            # Each waiter is registered before the message that triggers the reply
+            asked = {}
+            waiter = self.expect_reply(batch_bot.id, predicate, asked)
+            try:
+                sent = await send(batch_bot)
+            except BaseException:
+                waiter.cancel()
+                raise
+            sent = sent[0] if isinstance(sent, list) else sent
+            asked["id"] = getattr(sent, "id", None)
+            self.last_sent_id = max(self.last_sent_id, asked["id"] or 0)
+            logger.info(f"[Link] {request.key[0]} step {index + 1}/{len(request.steps)} sent.")
+            if index == len(request.steps) - 1:
+                return waiter
+            if await wait_for_reply(waiter, "dialogue") is None:
+                return None
+            self.expire_link_waits(request)
+
+    def expire_link_waits(self, request):
+        """
+        The bot answered a later request, so it is done with every earlier one:
+        an earlier request still without a link got an error instead, and must
+        not take a link meant for this one.
+        """
+        for earlier, waiter in list(self.link_waits):
+            if earlier is not request:
+                logger.warning(f"[Link] Batch bot moved on without a link for {earlier.key}.")
+                if not waiter.future.done():
+                    waiter.future.set_result(None)
+                waiter.cancel()
+
+    async def await_link(self, request, waiter, in_flight):
+        try:
+            self.finish(request, await wait_for_link(waiter))
+        finally:
+            self.link_waits.remove((request, waiter))
+            in_flight.release()
+
+    def finish(self, request, link):
+        self.pending.pop(request.key, None)
+        if link:
+            self.generated += 1
+        else:
+            self.failed += 1
+        if not request.future.done():
+            request.future.set_result(link)
+
+link_service = LinkService()
+
+@metrics.collector
+def link_service_metrics():
+    return [
+        ("srp_link_queue_depth", "gauge", {}, len(link_service.pending)),
+        ("srp_links_total", "counter", {"result": "ok"}, link_service.generated),
+        ("srp_links_total", "counter", {"result": "failed"}, link_service.failed),
+    ]
+
+class CaptionEditor:
+    """
+    Gathers caption edits for CAPTION_EDIT_BATCH_WINDOW seconds and sends each
+    channel's batch together at high priority. Edits of one message within a
+    window collapse into the newest text. Telegram has no multi-message edit,
+    so a batch is still one edit_message call per post, paced by api_scheduler.
+    """
+
+    def __init__(self):
+        self.pending = {}   # (chat, msg_id) -> [text, futures]
+        self.flusher = None
+
+    async def edit(self, chat, msg_id, text):
+        future = asyncio.get_running_loop().create_future()
+        entry = self.pending.setdefault((chat, msg_id), [text, []])
+        entry[0] = text
+        entry[1].append(future)
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.ensure_future(self.flush_later())
+        return await future
+
+    async def flush_later(self):
+        # Edits queued while a batch is being sent form the next batch
+        while self.pending:
+            await asyncio.sleep(CAPTION_EDIT_BATCH_WINDOW)
+            batch, self.pending = self.pending, {}
+            by_chat = {}
+            for (chat, msg_id), entry in batch.items():
+                by_chat.setdefault(chat, []).append((msg_id, entry))
+            for chat, edits in by_chat.items():
+                logger.info(f"[Caption] Editing {len(edits)} posts in {chat}.")
+                results = await asyncio.gather(*(
+                    api_call(client.edit_message, chat, msg_id, text, parse_mode="html", priority=PRIORITY_HIGH)
+                    for msg_id, (text, _) in edits), return_exceptions=True)
+                for (_, (_, futures)), result in zip(edits, results):
+                    for future in futures:
+                        if future.done():
+                            continue
+                        if isinstance(result, BaseException):
+                            future.set_exception(result)
+                        else:
+                            future.set_result(result)
+
+caption_editor = CaptionEditor()
+
+# ======== Bot dialogue waits ========
+reply_waiters = []  # ReplyWaiter objects still waiting for a message
+
+class ReplyWaiter:
+    """
+    A pending wait for the next incoming message in chat_id that matches
+    predicate. Resolved by dispatch_bot_replies, so waiting costs no API calls.
+    """
+
+    def __init__(self, chat_id, predicate):
+        self.chat_id = chat_id
+        self.predicate = predicate
+        self.future = asyncio.get_running_loop().create_future()
+
+    async def wait(self, timeout=REPLY_TIMEOUT):
+        """Return the matching message, or None after timeout seconds."""
+        try:
+            return await asyncio.wait_for(self.future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.cancel()
+
+    def cancel(self):
+        if self in reply_waiters:
+            reply_waiters.remove(self)
+        if not self.future.done():
+            self.future.cancel()
+
+def expect_message(chat_id, predicate):
+    """
+    Start waiting for a message in chat_id. Call this before sending whatever
+    triggers the reply so that an instant reply can't be missed.
+    """
+    waiter = ReplyWaiter(chat_id, predicate)
+    reply_waiters.append(waiter)
+    return waiter
+
+def reply_contains(expected_text):
+    return lambda msg: expected_text in (msg.message or "").lower()
+
+def reply_has_link(msg):
+    return batch_link_regex.search(msg.message or "") is not None
+
+@client.on(events.NewMessage(incoming=True))
+async def dispatch_bot_replies(event):
+    for waiter in list(reply_waiters):
+        if waiter.chat_id != event.chat_id or waiter.future.done():
             continue
-        match = batch_link_regex.search(msgs[0].message or "")
-        if match:
-            return match.group(0)
-        await asyncio.sleep(2)
-    return None
+        try:
+            matched = waiter.predicate(event.message)
+        except Exception as e:
+            logger.error(f"[Wait Error] predicate failed: {e}")
+            matched = False
+        if matched:
+            waiter.future.set_result(event.message)
+            reply_waiters.remove(waiter)
+            break  # one reply answers one request
+
+async def wait_for_reply(waiter, description):
+    with metrics.span("dialogue_wait", reply=description):
+        msg = await waiter.wait()
+    if msg is None:
+        metrics.inc("srp_failures_total", span="dialogue_wait")
+        logger.warning(f"[Wait] No '{description}' reply within {REPLY_TIMEOUT}s.")
+    return msg
+
+async def wait_for_link(waiter):
+    msg = await wait_for_reply(waiter, "link")
+    match = batch_link_regex.search(msg.message or "") if msg else None
+    return match.group(0) if match else None
 
 if __name__ == "__main__":
     print("✅ Bot running. Monitoring your private channel for media batches and single files...")
     client.start()
-    client.run_until_disconnected()
+    client.loop.run_until_complete(accounts.start())
+    client.loop.create_task(resume_jobs())
+    if METRICS_PORT:
+        client.loop.create_task(serve_metrics())
+    try:
+        client.run_until_disconnected()
+    finally:
+        if image_pool:
+            image_pool.shutdown()